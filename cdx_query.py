@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+""" Copyright(c)2012-2013 Internet Archive. Software license AGPL version 3.
+
+Look up the captures of a url in a sorted cdx file, as written by
+`cdx_writer.py --sort` or `cdx_writer.py --merge`.
+
+The cdx file is memory-mapped and binary searched on the N b key (massaged url
+and date), so only the pages holding the matching lines are read. Block
+compressed indexes written by --merge are searched through their summary
+index, and only the gzip blocks that can hold matches are inflated. Matching
+lines are yielded one at a time, so large result sets are streamed.
+"""
+
+from surt import surt #from https://github.com/rajbot/surt
+
+import os
+import sys
+import mmap
+import zlib
+import itertools
+from optparse import OptionParser
+
+
+match_types = ['exact', 'prefix', 'host']
+
+
+class SortedCDX(object):
+    """A sorted cdx file, plain or block compressed, that is searched without
+    reading all of it. Block compressed files are found by their gzip magic
+    and need the summary index that --merge wrote next to them.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, path, summary_file=None):
+        self.path = path
+        self.f    = open(path, 'rb')
+        self.data = map_file(self.f)
+        if self.data is None:
+            raise ValueError('%s is empty' % path)
+
+        self.summary_f = None
+        self.summary   = None
+        if self.data[:2] == '\x1f\x8b':
+            summary_file = summary_file or path + '.idx'
+            if not os.path.exists(summary_file):
+                raise ValueError('%s is compressed, but has no summary index %s' % (path, summary_file))
+            self.summary_f = open(summary_file, 'rb')
+            self.summary   = map_file(self.summary_f)
+            self.header    = self.read_header_block()
+        else:
+            self.header = self.data[:self.data.find('\n')]
+
+        if not self.header.startswith(' CDX '):
+            raise ValueError('%s has no CDX header' % path)
+        if self.header.split()[1:3] != ['N', 'b']:
+            raise ValueError('%s is not keyed by massaged url and date, its format is %r' % (path, self.header))
+
+    # read_header_block()
+    #___________________________________________________________________________
+    def read_header_block(self):
+        """The header is the gzip member in front of the first block.
+        """
+        z = zlib.decompressobj(16+zlib.MAX_WBITS)
+        return z.decompress(self.data[:64*1024]).split('\n', 1)[0]
+
+    # lines_from()
+    #___________________________________________________________________________
+    def lines_from(self, key):
+        """Yields the lines of the file from the first line that is not less
+        than key to the end of the file.
+        """
+        if self.summary_f is None:
+            return iter_lines(self.data, bisect_lines(self.data, key))
+        return self.block_lines_from(key)
+
+    # block_lines_from()
+    #___________________________________________________________________________
+    def block_lines_from(self, key):
+        summary = self.summary
+        if summary is None:
+            return #an index without any cdx lines has an empty summary
+
+        #the first block with a key not less than key can be preceded by a
+        #block that holds the first matches
+        offset = bisect_lines(summary, key)
+        if offset > 0:
+            offset = summary.rfind('\n', 0, offset - 1) + 1
+
+        for entry in iter_lines(summary, offset):
+            fields = entry.split('\t')
+            start, length = int(fields[2]), int(fields[3])
+            block = zlib.decompress(self.data[start:start+length], 16+zlib.MAX_WBITS)
+            for line in block.splitlines():
+                if line >= key:
+                    yield line
+
+    # query()
+    #___________________________________________________________________________
+    def query(self, url, match_type='exact', from_date=None, to_date=None):
+        """Yields the cdx lines of url that were captured between from_date
+        and to_date. match_type 'exact' matches the url itself, 'prefix' any
+        url that starts with it and 'host' any url on its host. Dates are
+        prefixes of 14 digit timestamps, so '2012' covers that whole year.
+        """
+        prefix = get_url_prefix(url, match_type)
+        start  = prefix
+        if from_date is not None:
+            from_date = pad_date(from_date, '0')
+            if 'exact' == match_type:
+                start = prefix + from_date
+        if to_date is not None:
+            to_date = pad_date(to_date, '9')
+
+        for line in self.lines_from(start):
+            if not line.startswith(prefix):
+                break
+            if from_date is not None or to_date is not None:
+                date = line.split(' ', 2)[1]
+                if from_date is not None and date < from_date:
+                    continue
+                if to_date is not None and date > to_date:
+                    if 'exact' == match_type:
+                        break #the rest of the url's lines are later still
+                    continue
+            yield line
+
+    # close()
+    #___________________________________________________________________________
+    def close(self):
+        self.data.close()
+        self.f.close()
+        if self.summary is not None:
+            self.summary.close()
+        if self.summary_f is not None:
+            self.summary_f.close()
+
+
+# map_file()
+#_______________________________________________________________________________
+def map_file(f):
+    """Memory-maps the open file f read-only. Returns None for an empty file,
+    which can't be mapped.
+    """
+    if 0 == os.fstat(f.fileno()).st_size:
+        return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# bisect_lines()
+#_______________________________________________________________________________
+def bisect_lines(buf, key):
+    """Returns the offset of the first line in buf, a sorted string or mmap of
+    lines, that is not less than key, or len(buf) if there is none.
+
+    >>> buf = 'a 1\\nb 1\\nb 2\\nc 1\\n'
+    >>> bisect_lines(buf, 'b'), bisect_lines(buf, 'b 2'), bisect_lines(buf, 'd')
+    (4, 8, 16)
+    >>> bisect_lines('a\\nc', 'b'), bisect_lines('a\\nc', 'd')
+    (2, 3)
+    """
+    lo, hi = 0, len(buf)
+    while lo < hi:
+        mid   = (lo + hi) // 2
+        start = buf.rfind('\n', lo, mid)
+        start = lo if -1 == start else start + 1
+        end   = buf.find('\n', start)
+        if -1 == end:
+            end = len(buf)
+        if buf[start:end] < key:
+            lo = min(end + 1, hi)
+        else:
+            hi = start
+    return lo
+
+# iter_lines()
+#_______________________________________________________________________________
+def iter_lines(buf, offset):
+    """Yields the lines of buf that start at or after offset, without their
+    newlines.
+
+    >>> list(iter_lines('a 1\\nb 1\\nb 2', 4))
+    ['b 1', 'b 2']
+    """
+    size = len(buf)
+    while offset < size:
+        end = buf.find('\n', offset)
+        if -1 == end:
+            end = size
+        yield buf[offset:end]
+        offset = end + 1
+
+# get_url_prefix()
+#_______________________________________________________________________________
+def get_url_prefix(url, match_type):
+    """Returns the start of the cdx lines that match url.
+
+    >>> get_url_prefix('http://www.example.com/', 'exact')
+    'com,example)/ '
+    >>> get_url_prefix('example.com/foo', 'prefix')
+    'com,example)/foo'
+    >>> get_url_prefix('http://example.com:8080/a?b=1', 'host')
+    'com,example:8080)'
+    """
+    surt_url = surt(url)
+    if 'exact' == match_type:
+        return surt_url + ' '
+    elif 'prefix' == match_type:
+        return surt_url
+    elif 'host' == match_type:
+        end = surt_url.find(')')
+        if -1 == end:
+            raise ValueError('No host in url: ' + url)
+        return surt_url[:end+1]
+    raise ValueError('Unknown match type: ' + match_type)
+
+# pad_date()
+#_______________________________________________________________________________
+def pad_date(date, digit):
+    """Pads a date prefix to a 14 digit timestamp.
+
+    >>> pad_date('2012', '0'), pad_date('201203', '9')
+    ('20120000000000', '20120399999999')
+    """
+    if not date.isdigit() or len(date) > 14:
+        raise ValueError('Dates must be 1 to 14 digits: ' + date)
+    return date + digit * (14 - len(date))
+
+
+# main()
+#_______________________________________________________________________________
+if __name__ == '__main__':
+
+    parser = OptionParser(usage="%prog [options] sorted.cdx url")
+    parser.set_defaults(match_type   = 'exact',
+                        from_date    = None,
+                        to_date      = None,
+                        limit        = None,
+                        summary_file = None,
+                       )
+
+    parser.add_option("--match-type", dest="match_type", choices=match_types, help="exact matches the url, prefix any url that starts with it, host any url on its host [default: %default]")
+    parser.add_option("--from", dest="from_date", help="Only captures at or after this date, 1 to 14 digits of a timestamp")
+    parser.add_option("--to", dest="to_date", help="Only captures at or before this date, 1 to 14 digits of a timestamp")
+    parser.add_option("--limit", dest="limit", type="int", help="Stop after this many lines")
+    parser.add_option("--summary-file", dest="summary_file", help="Summary index of a block compressed cdx [default: CDX_FILE.idx]")
+
+    (options, args) = parser.parse_args(args=sys.argv[1:])
+    if len(args) != 2:
+        parser.print_help()
+        exit(-1)
+
+    cdx = SortedCDX(args[0], options.summary_file)
+    lines = cdx.query(args[1], options.match_type, options.from_date, options.to_date)
+    for line in itertools.islice(lines, options.limit):
+        sys.stdout.write(line + '\n')
+    cdx.close()
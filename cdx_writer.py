@@ -8,32 +8,1180 @@ http://code.hanzoarchives.com/warc-tools/src/tip/hanzo/warctools
 This script is loosely based on warcindex.py:
 http://code.hanzoarchives.com/warc-tools/src/1897e2bc9d29/warcindex.py
 
-The functions that start with "get_" (as opposed to "parse_") are called by the
-dispatch loop in make_cdx using getattr().
+The functions that start with "get_" (as opposed to "parse_") are looked up
+with getattr() when the --format string is compiled in CDX_Writer.__init__, and
+called for every record by make_cdx.
 """
-from warctools import ArchiveRecord #from https://bitbucket.org/rajbot/warc-tools
-from surt      import surt          #from https://github.com/rajbot/surt
-
 import os
 import re
 import sys
+import time
 import base64
-import chardet
-import hashlib
-import json
-import urllib
-import urlparse
-from datetime  import datetime
+import bisect
+import heapq
+import itertools
+import mmap
+import zlib
+import shutil
+import signal
+import stat
+import struct
+import fcntl
+from collections import OrderedDict
 from optparse  import OptionParser
 
 
+class LazyImport(object):
+    """Stands in for a module, or a name imported from one, until it is first
+    used. The import happens then, and the global of the same name in this
+    module is replaced with the real object, so later uses go straight to it.
+
+    Many runs index a single small file, so loading modules that a run doesn't
+    need is a real part of its run time.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, module, name=None):
+        self._lazy_module = module
+        self._lazy_name   = name
+
+    # _lazy_load()
+    #___________________________________________________________________________
+    def _lazy_load(self):
+        """Every attribute of the placeholder has a _lazy_ prefix, so none of
+        them hides an attribute of the module, like json.load.
+        """
+        obj = __import__(self._lazy_module)
+        if self._lazy_name is not None:
+            obj = getattr(obj, self._lazy_name)
+        globals()[self._lazy_name or self._lazy_module] = obj
+        return obj
+
+    # __getattr__()
+    #___________________________________________________________________________
+    def __getattr__(self, attr):
+        return getattr(self._lazy_load(), attr)
+
+    # __call__()
+    #___________________________________________________________________________
+    def __call__(self, *args, **kwargs):
+        return self._lazy_load()(*args, **kwargs)
+
+
+ArchiveRecord   = LazyImport('warctools', 'ArchiveRecord') #from https://bitbucket.org/rajbot/warc-tools
+surt            = LazyImport('surt', 'surt')               #from https://github.com/rajbot/surt
+chardet         = LazyImport('chardet')   #only for non-ascii urls that aren't utf-8
+hashlib         = LazyImport('hashlib')
+json            = LazyImport('json')
+urlparse        = LazyImport('urlparse')
+datetime        = LazyImport('datetime', 'datetime')
+tempfile        = LazyImport('tempfile')
+multiprocessing = LazyImport('multiprocessing')
+socket          = LazyImport('socket')
+threading       = LazyImport('threading')
+traceback       = LazyImport('traceback')
+SocketServer    = LazyImport('SocketServer')
+
+# import_zstandard()
+#_______________________________________________________________________________
+def import_zstandard():
+    """Returns the zstandard module, or None if it isn't installed. It is
+    optional, and only needed for zstd compression.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
 class ParseError(Exception):
     pass
 
+# new_stats()
+#_______________________________________________________________________________
+def new_stats():
+    """Returns the per-run counters written to --stats-file. Runs that are
+    split across processes combine their counters with add_stats().
+    """
+    return {
+        'num_records_processed':   0,
+        'num_records_included':    0,
+        'num_records_filtered':    0,
+        'num_digests_verified':    0,
+        'num_digest_mismatches':   0,
+        'digest_mismatch_offsets': [],
+        'digest_bytes_hashed':     0,
+        'digest_seconds':          0.0,
+        'surt_cache_hits':         0,
+        'surt_cache_misses':       0,
+        'num_urls_decoded_utf8':   0,
+        'num_urls_decoded_by_host': 0,
+        'num_urls_decoded_chardet': 0,
+        'num_duplicate_payloads':  0,
+        'duplicate_payload_bytes': 0,
+    }
+
+# add_stats()
+#_______________________________________________________________________________
+def add_stats(total, stats):
+    for key in new_stats():
+        total[key] += stats[key]
+    if 'profile' in stats:
+        add_profile(total.setdefault('profile', {}), stats['profile'])
+
+# add_profile()
+#_______________________________________________________________________________
+def add_profile(total, profile):
+    for stage, counts in profile.iteritems():
+        stage_total = total.setdefault(stage, {'calls': 0, 'seconds': 0.0})
+        stage_total['calls']   += counts['calls']
+        stage_total['seconds'] = round(stage_total['seconds'] + counts['seconds'], 6)
+
+# finish_stats()
+#_______________________________________________________________________________
+def finish_stats(stats):
+    """Adds rates derived from the counters.
+    """
+    if stats['digest_seconds'] > 0:
+        stats['digest_bytes_per_sec'] = round(stats['digest_bytes_hashed'] / stats['digest_seconds'], 2)
+    stats['digest_seconds'] = round(stats['digest_seconds'], 6)
+    lookups = stats['surt_cache_hits'] + stats['surt_cache_misses']
+    if lookups > 0:
+        stats['surt_cache_hit_rate'] = round(float(stats['surt_cache_hits']) / lookups, 4)
+    return stats
+
+class MappedPrefixes(object):
+    """Read-only sequence view of the prefixes stored in a compiled exclude
+    index. Items are sliced out of the memory map on demand, so bisect can
+    search the index without reading it into memory.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, buf, num_entries, table_start):
+        self.buf         = buf
+        self.num_entries = num_entries
+        self.table_start = table_start
+        self.data_start  = table_start + 8 * (num_entries + 1)
+
+    # __len__()
+    #___________________________________________________________________________
+    def __len__(self):
+        return self.num_entries
+
+    # __getitem__()
+    #___________________________________________________________________________
+    def __getitem__(self, i):
+        start, end = struct.unpack_from('<QQ', self.buf, self.table_start + 8*i)
+        return self.buf[self.data_start+start:self.data_start+end]
+
+
+class ExcludeIndex(object):
+    """A sorted list of SURT prefixes, searched with bisect.
+
+    Prefixes that are covered by a shorter prefix in the list are dropped when
+    the index is built, so that no remaining prefix is a prefix of another.
+    The only candidate that can match a url is then the greatest prefix that
+    sorts <= the url, and a lookup is a single binary search.
+
+    The index can be compiled to a file that is memory-mapped by later runs.
+    The file stores the mtime, size and sha1 of the exclude list it was built
+    from, and is rebuilt when the exclude list changes. Layout:
+        header (magic, mtime, size, sha1, num_prefixes, num_entries)
+        num_entries+1 little-endian uint64 offsets into the data section
+        data section: the collapsed prefixes, concatenated in sorted order
+    """
+
+    magic  = 'CDXEXCL1'
+    header = struct.Struct('<8sdQ20sQQ')
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, prefixes):
+        start = time.time()
+        self.num_prefixes = 0
+        self.prefixes     = []
+        self.cached       = False
+        for prefix in sorted(prefixes):
+            self.num_prefixes += 1
+            if self.prefixes and prefix.startswith(self.prefixes[-1]):
+                continue
+            self.prefixes.append(prefix)
+        self.build_time = time.time() - start
+
+    # from_file()
+    #___________________________________________________________________________
+    @classmethod
+    def from_file(cls, exclude_list):
+        start = time.time()
+        prefixes = []
+        f = open(exclude_list, 'r')
+        for line in f:
+            if '' == line.strip():
+                continue
+            url = line.split()[0]
+            prefixes.append(surt(url))
+        f.close()
+
+        index = cls(prefixes)
+        index.build_time = time.time() - start
+        return index
+
+    # from_compiled()
+    #___________________________________________________________________________
+    @classmethod
+    def from_compiled(cls, exclude_list, index_file):
+        """Load index_file if it was compiled from the current exclude_list,
+        otherwise build the index from exclude_list and (re)write index_file.
+        """
+        start = time.time()
+        index = cls.load(index_file, exclude_list)
+        if index is None:
+            index = cls.from_file(exclude_list)
+            index.save(index_file, exclude_list)
+        index.build_time = time.time() - start
+        return index
+
+    # get_source_sha1()
+    #___________________________________________________________________________
+    @staticmethod
+    def get_source_sha1(exclude_list):
+        h = hashlib.sha1()
+        f = open(exclude_list, 'rb')
+        for chunk in iter(lambda: f.read(1024*1024), ''):
+            h.update(chunk)
+        f.close()
+        return h.digest()
+
+    # load()
+    #___________________________________________________________________________
+    @classmethod
+    def load(cls, index_file, exclude_list):
+        """Returns None if index_file is missing, corrupt or out of date.
+        """
+        if not os.path.exists(index_file):
+            return None
+
+        f = open(index_file, 'rb')
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, mmap.error):
+            return None
+        finally:
+            f.close()
+
+        if len(buf) < cls.header.size:
+            return None
+        magic, mtime, size, sha1, num_prefixes, num_entries = cls.header.unpack_from(buf)
+        if magic != cls.magic:
+            return None
+        if len(buf) < cls.header.size + 8 * (num_entries + 1):
+            return None
+
+        st = os.stat(exclude_list)
+        if (mtime, size) != (st.st_mtime, st.st_size):
+            #touched or edited, only rebuild if the contents changed
+            if sha1 != cls.get_source_sha1(exclude_list):
+                return None
+            #store the new mtime and size, so the next run doesn't hash again
+            header = cls.header.pack(cls.magic, st.st_mtime, st.st_size, sha1, num_prefixes, num_entries)
+            cls.rewrite_header(index_file, header, buf)
+
+        index = cls.__new__(cls)
+        index.num_prefixes = num_prefixes
+        index.prefixes     = MappedPrefixes(buf, num_entries, cls.header.size)
+        index.cached       = True
+        index.build_time   = 0
+        return index
+
+    # rewrite_header()
+    #___________________________________________________________________________
+    @classmethod
+    def rewrite_header(cls, index_file, header, buf):
+        """Replaces index_file with a copy of buf, the mapped index, that
+        has a new header. An index that can't be rewritten is still used, it
+        is just checked against the exclude list again by the next run.
+        """
+        tmp_file = '%s.tmp.%d' % (index_file, os.getpid())
+        try:
+            f = open(tmp_file, 'wb')
+            f.write(header)
+            f.write(buf[cls.header.size:])
+            f.close()
+            os.rename(tmp_file, index_file)
+        except (IOError, OSError):
+            if os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+
+    # save()
+    #___________________________________________________________________________
+    def save(self, index_file, exclude_list):
+        st = os.stat(exclude_list)
+        sha1 = self.get_source_sha1(exclude_list)
+
+        offsets = [0]
+        for prefix in self.prefixes:
+            if isinstance(prefix, unicode):
+                prefix = prefix.encode('utf-8')
+            offsets.append(offsets[-1] + len(prefix))
+
+        #write to a temp file and rename, so that concurrent runs never see
+        #a partially written index
+        tmp_file = '%s.tmp.%d' % (index_file, os.getpid())
+        f = open(tmp_file, 'wb')
+        f.write(self.header.pack(self.magic, st.st_mtime, st.st_size, sha1, self.num_prefixes, len(self.prefixes)))
+        f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        for prefix in self.prefixes:
+            if isinstance(prefix, unicode):
+                prefix = prefix.encode('utf-8')
+            f.write(prefix)
+        f.close()
+        os.rename(tmp_file, index_file)
+
+    # __len__()
+    #___________________________________________________________________________
+    def __len__(self):
+        return len(self.prefixes)
+
+    # matches()
+    #___________________________________________________________________________
+    def matches(self, surt_url):
+        i = bisect.bisect_right(self.prefixes, surt_url)
+        if 0 == i:
+            return False
+        return surt_url.startswith(self.prefixes[i-1])
+
+    # get_stats()
+    #___________________________________________________________________________
+    def get_stats(self):
+        return {
+            'exclude_list_size':        self.num_prefixes,
+            'exclude_index_size':       len(self.prefixes),
+            'exclude_index_build_time': round(self.build_time, 6),
+            'exclude_index_cached':     self.cached,
+        }
+
+
+class OutputSink(object):
+    """A write-only file-like object that batches cdx output into large
+    writes, optionally compressing it with gzip or zstd.
+
+    If out_file is a path, output goes to a temp file next to it, which is
+    renamed to out_file by close(). abort() removes the temp file, so a failed
+    run never leaves a partial cdx file in place. Streams such as stdout can't
+    be replaced atomically, so abort() just flushes what was written so far.
+    The same goes for paths that aren't regular files, like fifos, devices and
+    symlinks: they are opened and written in place, as a rename would replace
+    them.
+
+    Checkpointed runs pass a partial_path instead, which abort() leaves in
+    place. A resumed run reopens it truncated to resume_position, the output
+    position that sync() returned when the checkpoint was taken.
+    """
+
+    buffer_size = 1024 * 1024
+    compressions = {'gzip': '.gz', 'zstd': '.zst'}
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, out_file, compression=None, partial_path=None, resume_position=None):
+        if compression not in (None, 'gzip', 'zstd'):
+            raise ValueError('Unknown output compression: ' + compression)
+        if 'zstd' == compression and import_zstandard() is None:
+            raise ValueError('zstd output compression requires the zstandard module')
+        self.compression = compression
+        self.compressor  = self.new_compressor()
+        self.compressed  = 0
+
+        self.keep_partial = partial_path is not None
+        self.owns_file    = isinstance(out_file, basestring)
+        if self.owns_file and (partial_path or self.is_replaceable(out_file)):
+            self.path     = out_file
+            self.tmp_path = partial_path or '%s.tmp.%d' % (out_file, os.getpid())
+            if resume_position is not None:
+                self.out_file = open(self.tmp_path, 'r+b')
+                self.out_file.truncate(resume_position)
+                self.out_file.seek(resume_position)
+            else:
+                self.out_file = open(self.tmp_path, 'wb')
+        else:
+            self.path     = None
+            self.out_file = open(out_file, 'wb') if self.owns_file else out_file
+
+        self.position = resume_position or 0
+        self.chunks   = []
+        self.buffered = 0
+
+    # is_replaceable()
+    #___________________________________________________________________________
+    @staticmethod
+    def is_replaceable(path):
+        """Returns True if path is a regular file or doesn't exist yet, so a
+        temp file can be renamed over it.
+        """
+        try:
+            return stat.S_ISREG(os.lstat(path).st_mode)
+        except OSError:
+            return True
+
+    # new_compressor()
+    #___________________________________________________________________________
+    def new_compressor(self):
+        if 'gzip' == self.compression:
+            return zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+        elif 'zstd' == self.compression:
+            return import_zstandard().ZstdCompressor().compressobj()
+        return None
+
+    # write()
+    #___________________________________________________________________________
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self.write_buffer()
+
+    # write_buffer()
+    #___________________________________________________________________________
+    def write_buffer(self):
+        data = ''.join(self.chunks)
+        self.chunks   = []
+        self.buffered = 0
+        if not data:
+            return
+        if self.compressor is not None:
+            self.compressed += len(data)
+            data = self.compressor.compress(data)
+        self.write_raw(data)
+
+    # write_raw()
+    #___________________________________________________________________________
+    def write_raw(self, data):
+        if data:
+            self.out_file.write(data)
+            self.position += len(data)
+
+    # flush()
+    #___________________________________________________________________________
+    def flush(self):
+        self.write_buffer()
+        self.out_file.flush()
+
+    # close()
+    #___________________________________________________________________________
+    def close(self):
+        self.write_buffer()
+        if self.compressor is not None and (self.compressed > 0 or 0 == self.position):
+            self.write_raw(self.compressor.flush())
+        if self.path is not None:
+            self.out_file.close()
+            os.rename(self.tmp_path, self.path)
+        else:
+            self.out_file.flush()
+            if self.owns_file:
+                self.out_file.close()
+
+    # abort()
+    #___________________________________________________________________________
+    def abort(self):
+        if self.keep_partial:
+            #whatever follows the last checkpoint is truncated on resume
+            self.flush()
+            self.out_file.close()
+        elif self.path is not None:
+            self.chunks = []
+            self.out_file.close()
+            os.unlink(self.tmp_path)
+        else:
+            self.flush()
+            if self.owns_file:
+                self.out_file.close()
+
+    # end_stream()
+    #___________________________________________________________________________
+    def end_stream(self):
+        """Ends the current gzip member or zstd frame, if anything was written
+        to it, and returns the output position, where the next one will start.
+        """
+        self.write_buffer()
+        if self.compressor is not None and self.compressed > 0:
+            self.write_raw(self.compressor.flush())
+            self.compressor = self.new_compressor()
+            self.compressed = 0
+        return self.position
+
+    # sync()
+    #___________________________________________________________________________
+    def sync(self):
+        """Writes everything out to disk and returns the output position. A
+        compressed stream is ended here and a new gzip member or zstd frame is
+        started, so output can be resumed from the returned position.
+        """
+        position = self.end_stream()
+        self.out_file.flush()
+        if self.path is not None:
+            os.fsync(self.out_file.fileno())
+        return position
+
+
+class BoundedFile(object):
+    """A read-only view of a file that ends at offset end, so the archive
+    reader never sees a partially written gzip member past it.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, f, end):
+        self.f    = f
+        self.end  = end
+        self.name = f.name
+
+    # read()
+    #___________________________________________________________________________
+    def read(self, size=-1):
+        remaining = self.end - self.f.tell()
+        if remaining <= 0:
+            return ''
+        if size < 0 or size > remaining:
+            size = remaining
+        return self.f.read(size)
+
+    # readline()
+    #___________________________________________________________________________
+    def readline(self, size=-1):
+        remaining = self.end - self.f.tell()
+        if remaining <= 0:
+            return ''
+        if size < 0 or size > remaining:
+            size = remaining
+        return self.f.readline(size)
+
+    # tell()
+    #___________________________________________________________________________
+    def tell(self):
+        return self.f.tell()
+
+    # seek()
+    #___________________________________________________________________________
+    def seek(self, offset, whence=0):
+        if 2 == whence:
+            self.f.seek(self.end + offset)
+        else:
+            self.f.seek(offset, whence)
+
+    # close()
+    #___________________________________________________________________________
+    def close(self):
+        self.f.close()
+
+    # __getattr__()
+    #___________________________________________________________________________
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+class SplicedFile(object):
+    """A read-only file made of byte ranges of another file, read one after
+    the other. tell() and seek() use offsets in the underlying file, so a
+    reader sees each record at its real offset.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, f, ranges):
+        self.f      = f
+        self.ranges = ranges
+        self.name   = f.name
+        self.size   = sum(end - start for start, end in ranges)
+        self.pos    = 0 #position in the concatenated ranges
+
+    # locate()
+    #___________________________________________________________________________
+    def locate(self, pos):
+        """Returns the offset in the underlying file of position pos, and
+        how many bytes of its range follow it.
+        """
+        for start, end in self.ranges:
+            if pos < end - start:
+                return start + pos, end - start - pos
+            pos -= end - start
+        return self.ranges[-1][1], 0
+
+    # read()
+    #___________________________________________________________________________
+    def read(self, size=-1):
+        chunks = []
+        while size != 0 and self.pos < self.size:
+            offset, remaining = self.locate(self.pos)
+            if size > 0:
+                remaining = min(remaining, size)
+                size -= remaining
+            self.f.seek(offset)
+            data = self.f.read(remaining)
+            if not data:
+                break
+            chunks.append(data)
+            self.pos += len(data)
+        return ''.join(chunks)
+
+    # readline()
+    #___________________________________________________________________________
+    def readline(self, size=-1):
+        chunks = []
+        while size != 0 and self.pos < self.size:
+            offset, remaining = self.locate(self.pos)
+            if size > 0:
+                remaining = min(remaining, size)
+                size -= remaining
+            self.f.seek(offset)
+            line = self.f.readline(remaining)
+            if not line:
+                break
+            chunks.append(line)
+            self.pos += len(line)
+            if line.endswith('\n'):
+                break
+        return ''.join(chunks)
+
+    # tell()
+    #___________________________________________________________________________
+    def tell(self):
+        return self.locate(self.pos)[0]
+
+    # seek()
+    #___________________________________________________________________________
+    def seek(self, offset, whence=0):
+        if 1 == whence:
+            self.pos += offset
+        elif 2 == whence:
+            self.pos = self.size + offset
+        else:
+            pos = 0
+            for start, end in self.ranges:
+                if start <= offset <= end:
+                    self.pos = pos + offset - start
+                    break
+                pos += end - start
+            else:
+                raise IOError('Offset %d is outside the spliced ranges' % offset)
+
+    # close()
+    #___________________________________________________________________________
+    def close(self):
+        self.f.close()
+
+    # __getattr__()
+    #___________________________________________________________________________
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+class ExternalSort(object):
+    """A write-only file-like object that collects lines and writes them out
+    in byte order, matching `LC_ALL=C sort`.
+
+    Lines are kept in memory until they exceed buffer_size bytes, then sorted
+    and spilled to a temporary file. write_to() k-way merges the spilled runs.
+    Lines are compared without their trailing newline, as sort(1) does.
+    """
+
+    #merge the spilled runs into one when there are this many open temp files
+    max_runs = 64
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, buffer_size=100*1024*1024):
+        self.buffer_size = buffer_size
+        self.lines       = []
+        self.buffered    = 0
+        self.partial     = ''
+        self.runs        = []
+
+    # write()
+    #___________________________________________________________________________
+    def write(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        self.lines.extend(lines)
+        self.buffered += len(data)
+        if self.buffered > self.buffer_size:
+            self.spill()
+
+    # flush()
+    #___________________________________________________________________________
+    def flush(self):
+        pass
+
+    # spill()
+    #___________________________________________________________________________
+    def spill(self):
+        self.lines.sort()
+        f = tempfile.TemporaryFile(prefix='cdx_writer.sort.')
+        for line in self.lines:
+            f.write(line + '\n')
+        f.seek(0)
+        self.runs.append(f)
+        self.lines    = []
+        self.buffered = 0
+
+        if len(self.runs) >= self.max_runs:
+            f = tempfile.TemporaryFile(prefix='cdx_writer.sort.')
+            self.merge_runs(f)
+            f.seek(0)
+            self.runs = [f]
+
+    # write_to()
+    #___________________________________________________________________________
+    def write_to(self, out_file):
+        if self.partial:
+            self.lines.append(self.partial)
+            self.partial = ''
+
+        if not self.runs:
+            self.lines.sort()
+            for line in self.lines:
+                out_file.write(line + '\n')
+            self.lines = []
+            return
+
+        if self.lines:
+            self.spill()
+        self.merge_runs(out_file)
+
+    # merge_runs()
+    #___________________________________________________________________________
+    def merge_runs(self, out_file):
+        for line in heapq.merge(*[read_sorted_run(f) for f in self.runs]):
+            out_file.write(line + '\n')
+        for f in self.runs:
+            f.close()
+        self.runs = []
+
+
+# read_sorted_run()
+#_______________________________________________________________________________
+def read_sorted_run(f, skip_line=None):
+    """Yields the lines of a sorted file without their newlines, for heapq.merge()
+    """
+    for line in f:
+        line = line[:-1] if line.endswith('\n') else line
+        if line != skip_line:
+            yield line
+
+
+class DateNormalizer(object):
+    """Converts arc and warc record dates to 14-digit cdx timestamps.
+
+    warc dates in the usual YYYY-MM-DDThh:mm:ssZ form are converted by slicing
+    out the digits and range-checking them. Anything else goes through
+    datetime.strptime(), which also raises ValueError for invalid dates.
+    Records in a file tend to share timestamps, so recent results are cached;
+    the cache is simply emptied when it fills up.
+    """
+
+    cache_size    = 4096
+    hex_pattern   = re.compile('^[a-f0-9]+$')
+    days_in_month = (0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self):
+        self.cache = {}
+
+    # normalize()
+    #___________________________________________________________________________
+    def normalize(self, date):
+        try:
+            return self.cache[date]
+        except KeyError:
+            pass
+
+        timestamp = self.convert(date)
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[date] = timestamp
+        return timestamp
+
+    # convert()
+    #___________________________________________________________________________
+    def convert(self, date):
+        """
+        >>> d = DateNormalizer()
+        >>> d.convert('2011-02-18T23:32:56Z'), d.convert('200011201434'), d.convert('2000082305410049')
+        ('20110218233256', '20001120143400', '20000823054100')
+        >>> d.convert('200009180023002953'), d.convert('3a6b8e')
+        ('20000918002300', '-')
+        >>> d.convert('2012-2-9T1:02:03Z') #handled by strptime
+        '20120209010203'
+        """
+        if date.isdigit():
+            date_len = len(date)
+            if 14 == date_len:
+                #arc record already has date in the format we need
+                return date
+            elif 16 == date_len:
+                #some arc records have 16-digit dates: 2000082305410049
+                return date[:14]
+            elif 18 == date_len:
+                #some arc records have 18-digit dates: 200009180023002953
+                return date[:14]
+            elif 12 == date_len:
+                #some arc records have 12-digit dates: 200011201434
+                return date + '00'
+        elif self.hex_pattern.match(date):
+            #some arc records have a hex string in the date field
+            return '-'
+
+        #warc record
+        if (20 == len(date) and '-' == date[4] == date[7] and 'T' == date[10]
+            and ':' == date[13] == date[16] and 'Z' == date[19]):
+            timestamp = date[0:4] + date[5:7] + date[8:10] + date[11:13] + date[14:16] + date[17:19]
+            if timestamp.isdigit() and self.is_valid(timestamp):
+                return timestamp
+
+        #unusual formats, and invalid dates that should raise ValueError
+        date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
+        return date.strftime("%Y%m%d%H%M%S")
+
+    # is_valid()
+    #___________________________________________________________________________
+    def is_valid(self, timestamp):
+        """Range checks matching what strptime() and strftime() accept
+        """
+        year  = int(timestamp[0:4])
+        month = int(timestamp[4:6])
+        day   = int(timestamp[6:8])
+        if year < 1900 or not 1 <= month <= 12:
+            return False
+        if not 1 <= day <= self.days_in_month[month]:
+            return False
+        if 2 == month and 29 == day and not (0 == year % 4 and (0 != year % 100 or 0 == year % 400)):
+            return False
+        return timestamp[8:10] <= '23' and timestamp[10:12] <= '59' and timestamp[12:14] <= '59'
+
+
+class UrlDecoder(object):
+    """Decodes urls that contain non-ascii bytes.
+
+    A few arc files from 2002 have urls that are not utf-8, and the charset of
+    the page might not be specified, so chardet is used to make these usable.
+    chardet is slow, so it is the last resort: a url is first decoded as
+    strict utf-8, then as strict in the encoding chardet detected earlier for
+    another url on the same host. Only if both fail is chardet run.
+
+    A host's encoding is only reused if it is one of reusable_encodings,
+    multi-byte codecs that reject most bytes that aren't in them, so a url
+    that decodes without errors is very likely in that encoding. Single-byte
+    codecs like ISO-8859-1 accept any bytes, so one latin-1 guess would garble
+    every later url on the host, and SHIFT_JIS accepts most latin-1 text.
+    Urls chardet puts in those encodings are always passed to chardet.
+    """
+
+    reusable_encodings = frozenset(['GB2312', 'EUC-KR', 'EUC-JP', 'Big5'])
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, cache_size=10000):
+        self.host_encodings = LRUCache(cache_size)
+
+    # decode()
+    #___________________________________________________________________________
+    def decode(self, url, stats):
+        """
+        >>> d, stats = UrlDecoder(), new_stats()
+        >>> d.decode('http://example.com/\\xc3\\xa9', stats)
+        u'http://example.com/\\xe9'
+        >>> gb2312 = u'http://example.com/\\u65b0\\u95fb\\u4e2d\\u5fc3/'.encode('gb2312')
+        >>> d.decode(gb2312, stats) == gb2312.decode('gb2312')
+        True
+        >>> d.decode(gb2312 + '2', stats) == gb2312.decode('gb2312') + '2'
+        True
+        >>> stats['num_urls_decoded_utf8'], stats['num_urls_decoded_by_host'], stats['num_urls_decoded_chardet']
+        (1, 1, 1)
+
+        A latin-1 url doesn't decode as GB2312, so it is passed to chardet,
+        and its single-byte encoding isn't reused for the host:
+
+        >>> d.decode('http://example.com/\\xe9cole', stats)
+        u'http://example.com/\\xe9cole'
+        >>> d.host_encodings.get('example.com')
+        'GB2312'
+        """
+        try:
+            url = url.decode('utf-8')
+            stats['num_urls_decoded_utf8'] += 1
+            return url
+        except UnicodeDecodeError:
+            pass
+
+        host = self.get_host(url)
+        try:
+            decoded = url.decode(self.host_encodings.get(host))
+            stats['num_urls_decoded_by_host'] += 1
+            return decoded
+        except (KeyError, UnicodeDecodeError):
+            pass
+
+        stats['num_urls_decoded_chardet'] += 1
+        encoding = self.detect_encoding(url)
+        if encoding is None:
+            return url.decode('utf-8', 'replace')
+        if encoding in self.reusable_encodings:
+            self.host_encodings.put(host, encoding)
+        return url.decode(encoding, 'replace')
+
+    # get_host()
+    #___________________________________________________________________________
+    def get_host(self, url):
+        """
+        >>> UrlDecoder().get_host('http://user@Example.com:80/a/b?c'), UrlDecoder().get_host('dns:example.com')
+        ('user@Example.com:80', 'dns:example.com')
+        """
+        return url.split('://', 1)[-1].split('/', 1)[0]
+
+    # detect_encoding()
+    #___________________________________________________________________________
+    def detect_encoding(self, url):
+        """Returns the encoding chardet detects for url, or None if it can't
+        tell.
+        """
+        enc = chardet.detect(url)
+        if not enc or not enc['encoding']:
+            return None
+        if 'EUC-TW' == enc['encoding']:
+            # We don't have the EUC-TW encoding installed, and most likely
+            # something is so wrong that we probably can't recover this url
+            return 'Big5'
+        return enc['encoding']
+
+
+class LRUCache(object):
+    """A cache holding at most size entries. When it is full, the least
+    recently used entry is evicted. A size of 0 disables caching.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, size):
+        self.size    = size
+        self.entries = OrderedDict()
+
+    # __len__()
+    #___________________________________________________________________________
+    def __len__(self):
+        return len(self.entries)
+
+    # get()
+    #___________________________________________________________________________
+    def get(self, key):
+        """Returns the cached value, or raises KeyError.
+
+        >>> cache = LRUCache(2)
+        >>> cache.put('a', 1); cache.put('b', 2); cache.get('a'); cache.put('c', 3)
+        1
+        >>> sorted(cache.entries.keys())
+        ['a', 'c']
+        """
+        value = self.entries.pop(key)
+        self.entries[key] = value
+        return value
+
+    # put()
+    #___________________________________________________________________________
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class DigestIndex(object):
+    """The payload digests of the responses indexed so far, for finding
+    duplicate payloads within a crawl.
+
+    Digests are kept as raw 20 byte sha1 strings rather than 32 character
+    base32, to keep the index small. With keep_captures, the date and url of
+    the first capture of each digest are kept as well, so that save() can
+    write them out.
+
+    >>> index = DigestIndex()
+    >>> index.add('a' * 20), index.add('a' * 20), len(index)
+    (True, False, 1)
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, keep_captures=False):
+        self.keep_captures = keep_captures
+        self.digests = {} if keep_captures else set()
+
+    # __len__()
+    #___________________________________________________________________________
+    def __len__(self):
+        return len(self.digests)
+
+    # add()
+    #___________________________________________________________________________
+    def add(self, digest, capture=None):
+        """Returns True if digest wasn't in the index yet.
+        """
+        if digest in self.digests:
+            return False
+        if self.keep_captures:
+            self.digests[digest] = capture
+        else:
+            self.digests.add(digest)
+        return True
+
+    # save()
+    #___________________________________________________________________________
+    def save(self, path):
+        """Writes a sorted cdx with the base32 digest, date and url of the
+        first capture of each payload.
+        """
+        lines = sorted('%s %s\n' % (base64.b32encode(digest), capture) for digest, capture in self.digests.iteritems())
+        out = OutputSink(path)
+        out.write(' CDX k b a\n')
+        for line in lines:
+            out.write(line)
+        out.close()
+
+
+class Profiler(object):
+    """Accumulates wall time and call counts for the stages of indexing,
+    for --profile.
+
+    Times are exclusive: if a profiled method calls another one, as
+    parse_meta_tags() does when it needs parse_headers_and_content(), the time
+    spent in the inner call is only counted for the inner stage. A stage that
+    reenters itself is counted as one call.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self):
+        self.reset()
+
+    # reset()
+    #___________________________________________________________________________
+    def reset(self):
+        self.seconds = {}
+        self.calls   = {}
+        self.stack   = []
+
+    # start()
+    #___________________________________________________________________________
+    def start(self, stage):
+        now = time.time()
+        if self.stack:
+            outer = self.stack[-1]
+            self.seconds[outer[0]] = self.seconds.get(outer[0], 0.0) + now - outer[1]
+        self.stack.append([stage, now])
+
+    # stop()
+    #___________________________________________________________________________
+    def stop(self):
+        now = time.time()
+        stage, started = self.stack.pop()
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + now - started
+        if self.stack:
+            self.stack[-1][1] = now
+        if not self.stack or self.stack[-1][0] != stage:
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    # timed()
+    #___________________________________________________________________________
+    def timed(self, stage, func):
+        """Returns func wrapped so that its calls are counted under stage.
+        """
+        def timed_func(*args, **kwargs):
+            self.start(stage)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.stop()
+        return timed_func
+
+    # timed_getter()
+    #___________________________________________________________________________
+    def timed_getter(self, stage, getter):
+        """Like timed(), for getters that take use_precalculated_value. Calls
+        that return the value already calculated for the record are not
+        counted, so the count is the number of records the stage ran for.
+        """
+        timed_getter = self.timed(stage, getter)
+        def getter_func(record, use_precalculated_value=True):
+            if use_precalculated_value:
+                return getter(record)
+            return timed_getter(record, use_precalculated_value=False)
+        return getter_func
+
+    # timed_records()
+    #___________________________________________________________________________
+    def timed_records(self, records):
+        """Wraps a read_records() generator, timing only the reads.
+        """
+        while True:
+            self.start('read_records')
+            try:
+                item = next(records)
+            except StopIteration:
+                return
+            finally:
+                self.stop()
+            yield item
+
+    # get_stats()
+    #___________________________________________________________________________
+    def get_stats(self):
+        return dict((stage, {'calls': self.calls.get(stage, 0), 'seconds': round(seconds, 6)})
+                    for stage, seconds in self.seconds.iteritems())
+
+
+class per_record(object):
+    """Decorator for CDX_Writer attributes that are derived from the current
+    record. The value is computed on first access and cached in
+    writer.precalculated, which make_cdx clears for every record, so parsing
+    steps only run if a field in the format needs them.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, func):
+        self.func = func
+        self.name = func.__name__
+        self.__doc__ = func.__doc__
+
+    # __get__()
+    #___________________________________________________________________________
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return obj.precalculated[self.name]
+        except KeyError:
+            value = obj.precalculated[self.name] = self.func(obj)
+            return value
+
+    # __set__()
+    #___________________________________________________________________________
+    def __set__(self, obj, value):
+        obj.precalculated[self.name] = value
+
+
 class CDX_Writer(object):
+    #methods timed by --profile, in addition to read_records and output writes
+    profiled_methods = ['should_exclude', 'parse_headers_and_content', 'parse_meta_tags']
+    #getters whose value is calculated once per record, only the calls that
+    #calculate it are timed
+    profiled_getters = ['get_massaged_url', 'get_original_url', 'get_mime_type', 'get_new_style_checksum']
+
     # init()
     #___________________________________________________________________________
-    def __init__(self, file, out_file=sys.stdout, format="N b a m s k r M S V g", use_full_path=False, file_prefix=None, all_records=False, screenshot_mode=False, exclude_list=None, stats_file=None):
+    def __init__(self, file, out_file=sys.stdout, format="N b a m s k r M S V g", use_full_path=False, file_prefix=None, all_records=False, screenshot_mode=False, exclude_list=None, stats_file=None, exclude_index=None, processes=1, sort=False, sort_buffer_size=100*1024*1024, meta_tag_budget=1024*1024, verify_digests=False, output_compression=None, profile=False, surt_cache_size=65536, checkpoint_interval=0, resume=False, follow=False, follow_state=None, poll_interval=5, offsets=None, dedup=False, dedup_index=None):
 
         self.field_map = {'M': 'AIF meta tags',
                           'N': 'massaged url',
@@ -48,30 +1196,65 @@ class CDX_Writer(object):
                           's': 'response code',
                          }
 
+        #wrap the profiled methods before compile_format() binds the getters,
+        #so there is no cost when profiling is off
+        self.profiler = None
+        if profile:
+            self.profiler = Profiler()
+            for name in self.profiled_methods:
+                setattr(self, name, self.profiler.timed(name, getattr(self, name)))
+            for name in self.profiled_getters:
+                setattr(self, name, self.profiler.timed_getter(name, getattr(self, name)))
+
         self.file   = file
         self.out_file = out_file
         self.format = format
+        self.field_getters = self.compile_format(format)
         self.all_records  = all_records
         self.screenshot_mode = screenshot_mode
+        self.processes = processes
+        self.sort = sort
+        self.sort_buffer_size = sort_buffer_size
+        self.verify_digests = verify_digests
+        self.output_compression = output_compression
+        self.checkpoint_interval = checkpoint_interval
+        self.resume = resume
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.offsets = offsets
+        self.dedup_index_file = dedup_index
+        self.stats = new_stats()
+        self.date_normalizer = DateNormalizer()
+        self.surt_cache = LRUCache(surt_cache_size)
+        self.url_decoder = UrlDecoder()
         self.crlf_pattern = re.compile('\r?\n\r?\n')
         self.response_pattern = re.compile('^application/http;\s*msgtype=response$', re.I)
+        self.meta_scan_pattern = re.compile(r'<meta[^>]+?>|</head>|<body[\s>]', re.I)
+        self.meta_name_pattern = re.compile(r'''\b(?:name|http-equiv)\s*=\s*(['"]?)(.*?)(\1)[\s/>]''', re.I)
+        self.meta_content_pattern = re.compile(r'''\bcontent\s*=\s*(['"]?)(.*?)(\1)[\s/>]''', re.I)
 
         #similar to what what the wayback uses:
         self.fake_build_version = "archive-commons.0.0.1-SNAPSHOT-20120112102659-python"
 
         #these fields are set for each record in the warc
         self.offset        = 0
+        self.checkpoint_offset = None
+        self.input_file    = None
         self.surt          = None
-        self.mime_type     = None
-        self.headers       = None
-        self.content       = None
-        self.meta_tags     = None
-        self.response_code = None
+        self.record        = None
+
+        #headers, content, mime_type, response_code and meta_tags are
+        #per_record attributes, computed on demand and cached here
+        self.precalculated = {}
 
         #Large html files cause lxml to segfault
         #problematic file was 154MB, we'll stop at 5MB
         self.lxml_parse_limit = 5 * 1024 * 1024
 
+        #how far into an html document we look for meta tags if we don't
+        #find </head> or <body> first
+        self.meta_tag_budget = meta_tag_budget
+
         if use_full_path:
             self.warc_path = os.path.abspath(file)
         elif file_prefix:
@@ -79,16 +1262,16 @@ class CDX_Writer(object):
         else:
             self.warc_path = file
 
-        if exclude_list:
+        if isinstance(exclude_list, ExcludeIndex):
+            #already loaded, e.g. shared by the jobs of a batch worker
+            self.excludes = exclude_list
+        elif exclude_list:
             if not os.path.exists(exclude_list):
                 raise IOError, "Exclude file not found"
-            self.excludes = []
-            f = open(exclude_list, 'r')
-            for line in f:
-                if '' == line.strip():
-                    continue
-                url = line.split()[0]
-                self.excludes.append(surt(url))
+            if exclude_index:
+                self.excludes = ExcludeIndex.from_compiled(exclude_list, exclude_index)
+            else:
+                self.excludes = ExcludeIndex.from_file(exclude_list)
         else:
             self.excludes = None
 
@@ -99,6 +1282,120 @@ class CDX_Writer(object):
         else:
             self.stats_file = None
 
+        if checkpoint_interval or resume:
+            if not isinstance(out_file, basestring):
+                raise ValueError('Checkpoints require an output file')
+            if sort or processes > 1:
+                raise ValueError('Checkpoints can not be used with sort or multiple processes')
+            self.checkpoint_file = out_file + '.checkpoint'
+            self.partial_file    = out_file + '.partial'
+        else:
+            self.checkpoint_file = None
+
+        if follow or follow_state:
+            if sort or processes > 1 or checkpoint_interval or resume:
+                raise ValueError('Follow mode can not be used with sort, multiple processes or checkpoints')
+            self.follow_state_file = follow_state or file + '.follow'
+        else:
+            self.follow_state_file = None
+        self.filedesc_end = None
+
+        if offsets is not None and (checkpoint_interval or resume or self.follow_state_file):
+            raise ValueError('Offsets can not be used with checkpoints or follow mode')
+
+        if dedup or dedup_index:
+            if processes > 1 or checkpoint_interval or resume:
+                raise ValueError('The digest index can not be used with multiple processes or checkpoints')
+            self.digest_index = DigestIndex(keep_captures=dedup_index is not None)
+        else:
+            self.digest_index = None
+
+
+    # per-record values that are used multiple times
+    #___________________________________________________________________________
+    @per_record
+    def headers_and_content(self):
+        return self.parse_headers_and_content(self.record)
+
+    @per_record
+    def headers(self):
+        return self.headers_and_content[0]
+
+    @per_record
+    def content(self):
+        return self.headers_and_content[1]
+
+    @per_record
+    def header_index(self):
+        """The http headers as a dict keyed by lowercased header name.
+        """
+        return self.index_http_headers(self.headers)
+
+    @per_record
+    def original_url(self):
+        return self.get_original_url(self.record, use_precalculated_value=False)
+
+    @per_record
+    def mime_type(self):
+        return self.get_mime_type(self.record, use_precalculated_value=False)
+
+    @per_record
+    def response_code(self):
+        return self.get_response_code(self.record, use_precalculated_value=False)
+
+    @per_record
+    def meta_tags(self):
+        return self.parse_meta_tags(self.record)
+
+    @per_record
+    def new_style_checksum(self):
+        return self.get_new_style_checksum(self.record, use_precalculated_value=False)
+
+    # compile_format()
+    #___________________________________________________________________________
+    def compile_format(self, format):
+        """Returns a tuple of the bound get_ methods for the fields in format.
+        """
+        getters = []
+        for field in format.split():
+            if not field in self.field_map:
+                raise ParseError('Unknown field: ' + field)
+
+            endpoint = self.field_map[field].replace(' ', '_')
+            getters.append(getattr(self, 'get_' + endpoint))
+
+        return tuple(getters)
+
+    # index_http_headers()
+    #___________________________________________________________________________
+    @staticmethod
+    def index_http_headers(headers):
+        """Returns a dict that maps lowercased header names to values. If a
+        header is repeated, the first line with a non-empty value wins. Values
+        are what the regex 'name:\s*(.+)' would capture: leading whitespace is
+        removed unless the value is nothing but whitespace.
+
+        >>> index = CDX_Writer.index_http_headers(['HTTP/1.1 200 OK', 'Content-Type:', 'content-type:  text/html', 'CONTENT-TYPE: text/plain', 'X-Blank:   '])
+        >>> index['content-type'], index['x-blank']
+        ('text/html', ' ')
+        """
+        index = {}
+        if headers is None:
+            return index
+
+        for line in headers:
+            i = line.find(':')
+            if i <= 0:
+                continue
+            value = line[i+1:]
+            if '' == value:
+                continue
+            name = line[:i].lower()
+            if name in index:
+                continue
+            index[name] = value.lstrip(' \t\n\r\f\v') or value[-1]
+
+        return index
 
     # parse_http_header()
     #___________________________________________________________________________
@@ -106,12 +1403,7 @@ class CDX_Writer(object):
         if self.headers is None:
             return None
 
-        pattern = re.compile(header_name+':\s*(.+)', re.I)
-        for line in iter(self.headers):
-            m = pattern.match(line)
-            if m:
-                return m.group(1)
-        return None
+        return self.header_index.get(header_name.lower())
 
     # parse_http_content_type_header()
     #___________________________________________________________________________
@@ -180,11 +1472,6 @@ class CDX_Writer(object):
 
         meta_tags = {}
 
-        #lxml.html can't parse blank documents
-        html_str = self.content.strip()
-        if '' == html_str:
-            return meta_tags
-
         #lxml can't handle large documents
         if record.content_length > self.lxml_parse_limit:
             return meta_tags
@@ -194,38 +1481,40 @@ class CDX_Writer(object):
         # on the same warc files. Unfortunately, we don't ship a virtualenv,
         # so we're going to give up on lxml and use regexes to parse html :(
 
-        meta_tags = {}
-        #we only want to look for meta tags that occur before the </head> tag
-        head_limit = None
-        m = re.search('(</head>)', html_str, re.I)
-        if m:
-            head_limit = m.start(1)
+        #Scan a zero-copy view of at most meta_tag_budget bytes, in a single
+        #pass that stops at the end of the head. Blank documents contain no
+        #meta tags, so we don't need a strip()ed copy to detect them.
+        html_str = buffer(self.content, 0, self.meta_tag_budget)
 
-        for x in re.finditer("(<meta[^>]+?>)", html_str, re.I):
-            if head_limit is not None and x.start(1) >= head_limit:
+        for x in self.meta_scan_pattern.finditer(html_str):
+            tag = x.group(0)
+            if not tag[:5].lower() == '<meta':
+                #we only want to look for meta tags that occur before </head> or <body>
                 break
 
+            #a malformed meta tag can swallow the </head> tag
+            end_of_head = '</head>' in tag.lower()
+
             name = None
             content = None
 
-            m = re.search(r'''\b(?:name|http-equiv)\s*=\s*(['"]?)(.*?)(\1)[\s/>]''', x.group(1), re.I)
+            m = self.meta_name_pattern.search(tag)
             if m:
                 name = m.group(2).lower()
-            else:
-                continue
+                m = self.meta_content_pattern.search(tag)
+                if m:
+                    content = m.group(2)
 
-            m = re.search(r'''\bcontent\s*=\s*(['"]?)(.*?)(\1)[\s/>]''', x.group(1), re.I)
-            if m:
-                content = m.group(2)
-            else:
-                continue
+            if name is not None and content is not None:
+                if name not in meta_tags:
+                    meta_tags[name] = content
+                else:
+                    if 'refresh' != name:
+                        #for redirect urls, we only want the first refresh tag
+                        meta_tags[name] += ',' + content
 
-            if name not in meta_tags:
-                meta_tags[name] = content
-            else:
-                if 'refresh' != name:
-                    #for redirect urls, we only want the first refresh tag
-                    meta_tags[name] += ',' + content
+            if end_of_head:
+                break
 
         return meta_tags
 
@@ -279,16 +1568,28 @@ class CDX_Writer(object):
             return self.surt
 
         if 'warcinfo' == record.type:
-            return self.get_original_url(record)
+            return self.get_original_url(record, use_precalculated_value=False)
         else:
             url = record.url
             if self.screenshot_mode:
                 url = 'http://web.archive.org/screenshot/'+url
 
+            #crawls repeat urls a lot: robots.txt, revisits, dedup hits
+            key = (url, self.screenshot_mode)
+            try:
+                surt_url = self.surt_cache.get(key)
+                self.stats['surt_cache_hits'] += 1
+                return surt_url
+            except KeyError:
+                self.stats['surt_cache_misses'] += 1
+
             try:
-                return surt(url)
+                surt_url = surt(url)
             except:
-                return self.get_original_url(record)
+                return self.get_original_url(record, use_precalculated_value=False)
+
+            self.surt_cache.put(key, surt_url)
+            return surt_url
 
 
     # get_compressed_record_size() //field "S"
@@ -309,7 +1610,10 @@ class CDX_Writer(object):
 
     # get_original_url() //field "a"
     #___________________________________________________________________________
-    def get_original_url(self, record):
+    def get_original_url(self, record, use_precalculated_value=True):
+        if use_precalculated_value:
+            return self.original_url
+
         if 'warcinfo' == record.type:
             url = 'warcinfo:/%s/%s' % (self.file, self.fake_build_version)
             return url
@@ -317,22 +1621,12 @@ class CDX_Writer(object):
         url = record.url
 
         # There are few arc files from 2002 that have non-ascii characters in
-        # the url field. These are not utf-8 characters, and the charset of the
-        # page might not be specified, so use chardet to try and make these usable.
+        # the url field, see UrlDecoder
         if isinstance(url, str):
             try:
                 url.decode('ascii')
             except UnicodeDecodeError:
-                enc = chardet.detect(url)
-                if enc and enc['encoding']:
-                    if 'EUC-TW' == enc['encoding']:
-                        # We don't have the EUC-TW encoding installed, and most likely
-                        # something is so wrong that we probably can't recover this url
-                        url = url.decode('Big5', 'replace')
-                    else:
-                        url = url.decode(enc['encoding'], 'replace')
-                else:
-                    url = url.decode('utf-8', 'replace')
+                url = self.url_decoder.decode(url, self.stats)
 
         # Some arc headers contain urls with the '\r' character, which will cause
         # problems downstream when trying to process this url, so escape it.
@@ -345,35 +1639,14 @@ class CDX_Writer(object):
         if self.screenshot_mode:
             url = u'http://web.archive.org/screenshot/' + url
 
-        return url
-
-    # get_date() //field "b"
-    #___________________________________________________________________________
-    def get_date(self, record):
-        #warcs and arcs use a different date format
-        #consider using dateutil.parser instead
-
-        if record.date.isdigit():
-            date_len = len(record.date)
-            if 14 == date_len:
-                #arc record already has date in the format we need
-                return record.date
-            elif 16 == date_len:
-                #some arc records have 16-digit dates: 2000082305410049
-                return record.date[:14]
-            elif 18 == date_len:
-                #some arc records have 18-digit dates: 200009180023002953
-                return record.date[:14]
-            elif 12 == date_len:
-                #some arc records have 12-digit dates: 200011201434
-                return record.date + '00'
-        elif re.match('^[a-f0-9]+$', record.date):
-            #some arc records have a hex string in the date field
-            return '-'
-
-        #warc record
-        date = datetime.strptime(record.date, "%Y-%m-%dT%H:%M:%SZ")
-        return date.strftime("%Y%m%d%H%M%S")
+        return url
+
+    # get_date() //field "b"
+    #___________________________________________________________________________
+    def get_date(self, record):
+        #warcs and arcs use a different date format
+        #consider using dateutil.parser instead
+        return self.date_normalizer.normalize(record.date)
 
     # get_file_name() //field "g"
     #___________________________________________________________________________
@@ -396,10 +1669,12 @@ class CDX_Writer(object):
 
     # get_new_style_checksum() //field "k"
     #___________________________________________________________________________
-    def get_new_style_checksum(self, record):
+    def get_new_style_checksum(self, record, use_precalculated_value=True):
         """Return a base32-encoded sha1
         For revisit records, return the original sha1
         """
+        if use_precalculated_value:
+            return self.new_style_checksum
 
         if 'revisit' == record.type:
             digest = record.get_header('WARC-Payload-Digest')
@@ -418,11 +1693,58 @@ class CDX_Writer(object):
             if digest is not None:
                 return digest.replace('sha1:', '')
             else:
-                h = hashlib.sha1(self.content)
-                return base64.b32encode(h.digest())
+                return base64.b32encode(self.sha1_payload(self.content))
+        else:
+            return base64.b32encode(self.sha1_payload(record.content[1]))
+
+    # sha1_payload()
+    #___________________________________________________________________________
+    def sha1_payload(self, data):
+        """Returns the raw sha1 digest of data. The record parser has already
+        read the payload into memory, so it is hashed in one call. Time spent
+        hashing is counted in the stats.
+        """
+        start = time.time()
+        digest = hashlib.sha1(data).digest()
+        self.stats['digest_bytes_hashed'] += len(data)
+        self.stats['digest_seconds'] += time.time() - start
+        return digest
+
+    # verify_payload_digest()
+    #___________________________________________________________________________
+    def verify_payload_digest(self, record):
+        """Compare a sha1 WARC-Payload-Digest header with the sha1 of the payload.
+        The payload of an http response is the body after the http headers,
+        otherwise it is the whole record block. Revisit records carry the
+        digest of an earlier capture, so they are not checked.
+        """
+        if 'revisit' == record.type:
+            return
+
+        digest = record.get_header('WARC-Payload-Digest')
+        if digest is None or not digest.lower().startswith('sha1:'):
+            return
+
+        digest = digest[5:].strip()
+        try:
+            if 32 == len(digest):
+                expected = base64.b32decode(digest.upper())
+            elif 40 == len(digest):
+                expected = digest.decode('hex')
+            else:
+                return
+        except (TypeError, ValueError):
+            return
+
+        if self.headers is not None:
+            payload = self.content if self.content is not None else ''
         else:
-            h = hashlib.sha1(record.content[1])
-            return base64.b32encode(h.digest())
+            payload = record.content[1]
+
+        self.stats['num_digests_verified'] += 1
+        if self.sha1_payload(payload) != expected:
+            self.stats['num_digest_mismatches'] += 1
+            self.stats['digest_mismatch_offsets'].append(self.offset)
 
     # get_mime_type() //field "m"
     #___________________________________________________________________________
@@ -601,13 +1923,19 @@ class CDX_Writer(object):
         """Returns a list of header lines, split with splitlines(), and the content.
         We call splitlines() here so we only split once, and so \r\n and \n are
         split in the same way.
+
+        For http responses, the content is a read-only buffer() over the record
+        payload rather than a copy, so large bodies are not duplicated in memory.
         """
 
         if 'response' == record.type and record.content[1].startswith('HTTP'):
-            try:
-                headers, content = self.crlf_pattern.split(record.content[1], 1)
-            except ValueError:
-                headers = record.content[1]
+            payload = record.content[1]
+            m = self.crlf_pattern.search(payload)
+            if m:
+                headers = payload[:m.start()]
+                content = buffer(payload, m.end())
+            else:
+                headers = payload
                 content = None
             headers = headers.splitlines()
         elif  self.screenshot_mode and 'metadata' == record.type:
@@ -620,42 +1948,460 @@ class CDX_Writer(object):
         return headers, content
 
 
+    # index_digest()
+    #___________________________________________________________________________
+    def index_digest(self, record):
+        """Adds the payload digest of a response to the digest index, or
+        counts the response as a duplicate if the digest was seen before. The
+        compressed size of a duplicate is what a revisit record would have
+        saved.
+        """
+        if 'response' != record.type:
+            return
+        try:
+            digest = base64.b32decode(self.get_new_style_checksum(record))
+        except TypeError:
+            return #not a base32 sha1
+
+        capture = None
+        if self.digest_index.keep_captures:
+            capture = self.get_date(record) + ' ' + self.get_original_url(record).encode('utf-8')
+        if not self.digest_index.add(digest, capture):
+            self.stats['num_duplicate_payloads'] += 1
+            self.stats['duplicate_payload_bytes'] += record.compressed_record_size or 0
+
+    # save_digest_index()
+    #___________________________________________________________________________
+    def save_digest_index(self, stats):
+        if self.digest_index is None:
+            return
+        stats['num_unique_payloads'] = len(self.digest_index)
+        if self.dedup_index_file is not None:
+            self.digest_index.save(self.dedup_index_file)
+
     # should_exclude()
     #___________________________________________________________________________
     def should_exclude(self, surt_url):
         if not self.excludes:
             return False
 
-        for prefix in self.excludes:
-            if surt_url.startswith(prefix):
-                return True
-
-        return False
+        return self.excludes.matches(surt_url)
 
 
     # make_cdx()
     #___________________________________________________________________________
     def make_cdx(self):
-        if isinstance(self.out_file, basestring):
-            self.out_file = open(self.out_file, 'wb')
-        self.out_file.write(' CDX ' + self.format + '\n') #print header
+        if self.follow_state_file is not None:
+            return self.follow_cdx()
+
+        out_file = self.out_file
+        checkpoint = None
+        if self.resume:
+            checkpoint = self.load_checkpoint()
+
+        if self.checkpoint_file is None:
+            sink = OutputSink(out_file, self.output_compression)
+        elif checkpoint is None:
+            sink = OutputSink(out_file, self.output_compression, self.partial_file)
+        else:
+            sink = OutputSink(out_file, self.output_compression, self.partial_file, checkpoint['output_position'])
+
+        if self.sort:
+            #the header begins with a space, so it is sorted along with the cdx lines
+            self.out_file = ExternalSort(self.sort_buffer_size)
+        else:
+            self.out_file = sink
+
+        try:
+            if checkpoint is None:
+                self.out_file.write(' CDX ' + self.format + '\n') #print header
+                stats = new_stats()
+            else:
+                stats = checkpoint['stats']
+
+            if self.excludes is not None:
+                stats.update(self.excludes.get_stats())
+
+            boundaries = None
+            if self.processes > 1 and self.offsets is None:
+                boundaries = find_member_boundaries(self.file, self.processes)
+
+            if self.offsets is not None:
+                self.write_cdx_records_at(stats, self.offsets)
+            elif boundaries:
+                self.make_cdx_parallel(boundaries, stats)
+            elif checkpoint is not None:
+                self.resume_cdx_records(stats, checkpoint['offset'])
+            else:
+                self.write_cdx_records(stats)
+
+            if self.sort:
+                self.out_file.write_to(sink)
+
+            if self.profiler is not None:
+                add_profile(stats.setdefault('profile', {}), self.profiler.get_stats())
+        except:
+            sink.abort()
+            raise
+        finally:
+            self.out_file = out_file
+        sink.close()
+        if self.checkpoint_file is not None and os.path.exists(self.checkpoint_file):
+            os.unlink(self.checkpoint_file)
+
+        self.save_digest_index(stats)
+        return self.write_stats(stats)
+
+    # write_stats()
+    #___________________________________________________________________________
+    def write_stats(self, stats):
+        finish_stats(stats)
+        if self.stats_file is not None:
+            f = open(self.stats_file, 'w')
+            json.dump(stats, f, indent=4)
+            f.close()
+
+        return stats
+
+    # follow_cdx()
+    #___________________________________________________________________________
+    def follow_cdx(self):
+        """Index the records appended to a gzipped WARC or ARC file since the
+        offset saved in the follow state file, and save the new offset.
+
+        Only complete gzip members are indexed. A partially written member at
+        the end of the file is left for the next poll or run. The cdx header
+        is only written when the file is indexed from the beginning. Output
+        files are then replaced, and otherwise appended to. With follow set,
+        the file is polled every poll_interval seconds until it is removed or
+        renamed, or until KeyboardInterrupt.
+        """
+        #hold the input open, so records appended just before it is renamed
+        #are still indexed
+        self.input_file = open(self.file, 'rb')
+        try:
+            stats = self.follow_input(os.fstat(self.input_file.fileno()))
+        finally:
+            self.input_file.close()
+            self.input_file = None
+
+        if self.profiler is not None:
+            add_profile(stats.setdefault('profile', {}), self.profiler.get_stats())
+        self.save_digest_index(stats)
+        return self.write_stats(stats)
+
+    # follow_input()
+    #___________________________________________________________________________
+    def follow_input(self, input_stat):
+        """The polling loop of follow_cdx(). input_stat identifies the input file
+        that is being followed.
+        """
+        offset = self.load_follow_state()
+
+        out_file = self.out_file
+        own_file = isinstance(out_file, basestring)
+        if own_file:
+            f = open(out_file, 'wb' if 0 == offset else 'ab')
+            f.seek(0, os.SEEK_END)
+            synced_size = f.tell()
+        else:
+            f = out_file
+        sink = OutputSink(f, self.output_compression)
+
+        stats = new_stats()
+        if self.excludes is not None:
+            stats.update(self.excludes.get_stats())
+
+        self.out_file = sink
+        try:
+            if 0 == offset:
+                sink.write(' CDX ' + self.format + '\n') #print header
+            done = False
+            while True:
+                #a file that has been removed or replaced gets a last pass
+                try:
+                    done = not self.follow or not os.path.samestat(input_stat, os.stat(self.file))
+                except OSError:
+                    done = True
+
+                end = find_complete_members(self.input_file, offset)
+                if end > offset:
+                    if is_warc_record_at(self.input_file, offset):
+                        self.write_cdx_records(stats, start=offset, limit=end)
+                    else:
+                        self.write_cdx_records(stats, skip_before=offset, file_handle=self.open_arc_view(offset, end))
+                    offset = end
+                sink.sync()
+                if own_file:
+                    synced_size = f.tell()
+                self.save_follow_state(offset)
+
+                if done:
+                    break
+                try:
+                    time.sleep(self.poll_interval)
+                except KeyboardInterrupt:
+                    break
+        except:
+            if own_file:
+                #drop cdx lines for records that aren't in the saved state
+                f.truncate(synced_size)
+                f.close()
+            else:
+                sink.abort()
+            raise
+        finally:
+            self.out_file = out_file
+        sink.close()
+        if own_file:
+            f.close()
+
+        return stats
+
+    # load_follow_state()
+    #___________________________________________________________________________
+    def load_follow_state(self):
+        """Returns the offset up to which this file has been indexed, 0 if it
+        is not in the follow state file. The state file can be shared by
+        several inputs, entries are keyed by absolute path.
+        """
+        if os.fstat(self.input_file.fileno()).st_size > 0 and not is_gzip_file(self.input_file):
+            raise ValueError('Follow mode requires a gzipped WARC or ARC file')
+
+        lock = self.lock_follow_state()
+        try:
+            state = self.read_follow_states().get(os.path.abspath(self.file))
+        finally:
+            lock.close()
+        if state is None:
+            return 0
+        return state['offset']
+
+    # save_follow_state()
+    #___________________________________________________________________________
+    def save_follow_state(self, offset):
+        """Other processes following other inputs can share the state file,
+        so the file is reread under the lock and only this input's entry is
+        replaced.
+        """
+        lock = self.lock_follow_state()
+        try:
+            states = self.read_follow_states()
+            states[os.path.abspath(self.file)] = {'offset': offset}
+
+            tmp_file = '%s.%d.tmp' % (self.follow_state_file, os.getpid())
+            f = open(tmp_file, 'w')
+            json.dump(states, f, indent=4)
+            f.close()
+            os.rename(tmp_file, self.follow_state_file)
+        finally:
+            lock.close()
+
+    # lock_follow_state()
+    #___________________________________________________________________________
+    def lock_follow_state(self):
+        """Returns an open file that holds an exclusive lock on the follow
+        state until it is closed. The lock is taken on a separate .lock file,
+        because the state file itself is replaced by rename.
+        """
+        f = open(self.follow_state_file + '.lock', 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    # read_follow_states()
+    #___________________________________________________________________________
+    def read_follow_states(self):
+        if not os.path.exists(self.follow_state_file):
+            return {}
+        f = open(self.follow_state_file)
+        states = json.load(f)
+        f.close()
+        return states
+
+    # load_checkpoint()
+    #___________________________________________________________________________
+    def load_checkpoint(self):
+        """Returns the checkpoint left by an interrupted run, or None if there
+        is nothing to resume. Raises ValueError if the checkpoint was written
+        for a different input or different options.
+        """
+        if not os.path.exists(self.checkpoint_file) or not os.path.exists(self.partial_file):
+            return None
+
+        f = open(self.checkpoint_file)
+        checkpoint = json.load(f)
+        f.close()
+
+        #compare the options the way they look after a round trip through json
+        options = json.loads(json.dumps(self.get_checkpoint_options()))
+        for key, value in options.iteritems():
+            if checkpoint[key] != value:
+                raise ValueError('Checkpoint %s was written with %s=%r, not %r' % (self.checkpoint_file, key, checkpoint[key], value))
+
+        #the next checkpoints must fall on the same records as before
+        self.checkpoint_interval = checkpoint['checkpoint_interval']
+        return checkpoint
+
+    # get_checkpoint_options()
+    #___________________________________________________________________________
+    def get_checkpoint_options(self):
+        """Settings that must not change between a run and its resumption.
+        """
+        return {'input':              self.file,
+                'input_size':         os.path.getsize(self.file),
+                'format':             self.format,
+                'all_records':        self.all_records,
+                'screenshot_mode':    self.screenshot_mode,
+                'output_compression': self.output_compression,
+               }
+
+    # write_checkpoint()
+    #___________________________________________________________________________
+    def write_checkpoint(self, offset, stats):
+        """Records that all records before offset have been indexed. The
+        output is synced to disk before the checkpoint is replaced.
+        """
+        checkpoint = self.get_checkpoint_options()
+        checkpoint.update({'checkpoint_interval': self.checkpoint_interval,
+                           'offset':              offset,
+                           'output_position':     self.out_file.sync(),
+                           'stats':               stats,
+                          })
+
+        tmp_file = self.checkpoint_file + '.tmp'
+        f = open(tmp_file, 'w')
+        json.dump(checkpoint, f, indent=4)
+        f.close()
+        os.rename(tmp_file, self.checkpoint_file)
+        self.checkpoint_offset = offset
+
+    # resume_cdx_records()
+    #___________________________________________________________________________
+    def resume_cdx_records(self, stats, offset):
+        """Continue indexing at the record that begins at offset. WARC files
+        are read from offset. The arc parser needs the filedesc record, so
+        arc files are read through a view that puts it in front of offset.
+        """
+        self.checkpoint_offset = offset
+        f = open(self.file, 'rb')
+        is_warc = is_warc_record_at(f, offset)
+        f.close()
+        if is_warc:
+            return self.write_cdx_records(stats, start=offset)
+        else:
+            view = self.open_arc_view(offset, os.path.getsize(self.file))
+            return self.write_cdx_records(stats, skip_before=offset, file_handle=view)
+
+    # write_cdx_records_at()
+    #___________________________________________________________________________
+    def write_cdx_records_at(self, stats, offsets):
+        """Write cdx lines for the records at the given (offset, length) pairs,
+        without reading the rest of the file. A length of None means the
+        record is measured by find_record_end().
+
+        Each record is read through a view of the file that ends with it. arc
+        records can't be parsed without the filedesc record, so for arc files
+        the view is the filedesc record followed by the requested record.
+        """
+        f = self.open_input()
+        try:
+            is_warc = is_warc_record_at(f, 0)
+            for offset, length in offsets:
+                if length is None:
+                    end = find_record_end(f, offset)
+                else:
+                    end = offset + length
+
+                if is_warc:
+                    if not is_warc_record_at(f, offset):
+                        raise ParseError('No WARC record at offset %d' % offset)
+                    view = BoundedFile(self.open_input(), end)
+                    view.seek(offset)
+                    self.write_cdx_records(stats, file_handle=view)
+                    continue
+
+                self.write_cdx_records(stats, skip_before=offset, file_handle=self.open_arc_view(offset, end))
+        finally:
+            f.close()
+
+    # open_arc_view()
+    #___________________________________________________________________________
+    def open_arc_view(self, offset, end):
+        """Returns a view of the arc input that holds the records in [offset,
+        end), preceded by the filedesc record, which the arc parser needs. The
+        records before offset are not read.
+        """
+        f = self.open_input()
+        if self.filedesc_end is None:
+            self.filedesc_end = find_record_end(f, 0)
+            f.seek(0)
+        if offset < self.filedesc_end:
+            return BoundedFile(f, end)
+        return SplicedFile(f, [(0, self.filedesc_end), (offset, end)])
+
+    # open_input()
+    #___________________________________________________________________________
+    def open_input(self):
+        """Returns a new file object for the input. In follow mode this is a
+        duplicate of the handle follow_cdx() holds, which still works after the
+        input has been renamed.
+        """
+        if self.input_file is not None:
+            return os.fdopen(os.dup(self.input_file.fileno()), 'rb')
+        return open(self.file, 'rb')
 
+    # write_cdx_records()
+    #___________________________________________________________________________
+    def write_cdx_records(self, stats, start=0, end=None, skip_before=None, limit=None, file_handle=None):
+        """Write cdx lines for the records that begin in [start, end).
+        start must be the offset of a record. Returns the offset of the first
+        record at or past end, or None if the end of the file was reached.
+        Records before skip_before are read but not indexed, and the file is
+        read as if it ended at limit. If file_handle is given, records are
+        read from it instead of the input file, from its current position.
+        """
         if not self.all_records:
             #filter cdx lines if --all-records isn't specified
             allowed_record_types     = set(['response', 'revisit'])
             disallowed_content_types = set(['text/dns'])
 
-        stats = {
-            'num_records_processed': 0,
-            'num_records_included':  0,
-            'num_records_filtered':  0,
-        }
+        self.stats = stats
+
+        if file_handle is not None:
+            fh = ArchiveRecord.open_archive(file_handle=file_handle, gzip="auto", mode="r")
+        elif start or limit is not None:
+            f = self.open_input()
+            f.seek(start)
+            if limit is not None:
+                f = BoundedFile(f, limit)
+            fh = ArchiveRecord.open_archive(file_handle=f, gzip="auto", mode="r")
+        else:
+            fh = ArchiveRecord.open_archive(self.file, gzip="auto", mode="r")
+
+        records = fh.read_records(limit=None, offsets=True)
+        write   = self.out_file.write
+        if self.profiler is not None:
+            records = self.profiler.timed_records(records)
+            write   = self.profiler.timed('write', write)
 
-        fh = ArchiveRecord.open_archive(self.file, gzip="auto", mode="r")
-        for (offset, record, errors) in fh.read_records(limit=None, offsets=True):
+        next_offset = None
+        for (offset, record, errors) in records:
             self.offset = offset
 
+            if end is not None and offset >= end:
+                next_offset = offset
+                break
+
+            if skip_before is not None and offset < skip_before:
+                continue
+
             if record:
+                if (self.checkpoint_interval and 0 == stats['num_records_processed'] % self.checkpoint_interval
+                    and offset != self.checkpoint_offset):
+                    self.write_checkpoint(offset, stats)
+
+                self.record = record
+                self.precalculated = {}
                 stats['num_records_processed'] += 1
                 if self.screenshot_mode:
                     if record.type != 'metadata':
@@ -674,54 +2420,896 @@ class CDX_Writer(object):
                     stats['num_records_filtered'] += 1
                     continue
 
-                ### precalculated data that is used multiple times
-                self.headers, self.content = self.parse_headers_and_content(record)
-                self.mime_type             = self.get_mime_type(record, use_precalculated_value=False)
-                self.response_code         = self.get_response_code(record, use_precalculated_value=False)
-                self.meta_tags             = self.parse_meta_tags(record)
-
-                s = u''
-                for field in self.format.split():
-                    if not field in self.field_map:
-                        raise ParseError('Unknown field: ' + field)
-
-                    endpoint = self.field_map[field].replace(' ', '_')
-                    response = getattr(self, 'get_' + endpoint)(record)
-                    #print self.offset
-                    #print record.compressed_record_size
-                    #print record.content_length
-                    #print record.headers
-                    #print len(self.content)
-                    #print repr(record.content[1])
-                    #print endpoint
-                    #print repr(response)
-                    s += response + ' '
-                self.out_file.write(s.rstrip().encode('utf-8')+'\n')
+                s = u' '.join([getter(record) for getter in self.field_getters])
+                write(s.rstrip().encode('utf-8')+'\n')
                 #record.dump()
                 stats['num_records_included'] += 1
+
+                if self.verify_digests:
+                    self.verify_payload_digest(record)
+
+                if self.digest_index is not None:
+                    self.index_digest(record)
             elif errors:
                 raise ParseError(str(errors))
             else:
                 pass # tail
 
         fh.close()
+        return next_offset
 
-        if self.stats_file is not None:
-            f = open(self.stats_file, 'w')
-            json.dump(stats, f, indent=4)
+    # make_cdx_parallel()
+    #___________________________________________________________________________
+    def make_cdx_parallel(self, boundaries, stats):
+        """Index the byte ranges between boundaries in worker processes and
+        concatenate their output in offset order.
+
+        Each worker checks that the first record past its range starts exactly
+        at the next boundary. If any boundary turns out not to be a record
+        boundary, the chunk output is discarded and the file is indexed serially.
+        """
+        global range_writer
+        range_writer = self
+        self.out_file.flush() #don't let the workers inherit buffered output
+
+        tmp_dir = tempfile.mkdtemp(prefix='cdx_writer.')
+        try:
+            starts = [0] + boundaries
+            ends   = boundaries + [None]
+            jobs   = [(start, end, os.path.join(tmp_dir, '%06d.cdx' % i)) for i, (start, end) in enumerate(zip(starts, ends))]
+
+            pool = multiprocessing.Pool(len(jobs))
+            try:
+                results = pool.map(run_range_job, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+            for (start, end, output_file), (chunk_stats, next_offset) in zip(jobs, results):
+                if next_offset != end:
+                    sys.stderr.write('Gzip member at offset %s is not a record boundary, indexing serially\n' % end)
+                    self.write_cdx_records(stats)
+                    return
+
+            for (start, end, output_file), (chunk_stats, next_offset) in zip(jobs, results):
+                add_stats(stats, chunk_stats)
+                f = open(output_file, 'rb')
+                shutil.copyfileobj(f, self.out_file)
+                f.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+# Intra-file parallelism
+#
+# make_cdx_parallel() sets range_writer before creating its process pool, so
+# forked workers inherit the configured CDX_Writer.
+#_______________________________________________________________________________
+range_writer = None
+
+# run_range_job()
+#_______________________________________________________________________________
+def run_range_job(job):
+    start, end, output_file = job
+    stats = new_stats()
+    profiler = range_writer.profiler
+    if profiler is not None:
+        profiler.reset() #don't count what the parent did before forking
+    range_writer.out_file = open(output_file, 'wb')
+    next_offset = range_writer.write_cdx_records(stats, start, end)
+    range_writer.out_file.close()
+    if profiler is not None:
+        stats['profile'] = profiler.get_stats()
+    return stats, next_offset
+
+# is_warc_member()
+#_______________________________________________________________________________
+def is_warc_member(data):
+    """Returns True if data begins with a gzip member that decompresses to
+    the start of a WARC record.
+    """
+    z = zlib.decompressobj(16+zlib.MAX_WBITS)
+    try:
+        out = z.decompress(data, 16)
+    except zlib.error:
+        return False
+    return out.startswith('WARC/')
+
+# is_gzip_file()
+#_______________________________________________________________________________
+def is_gzip_file(f):
+    f.seek(0)
+    return '\x1f\x8b' == f.read(2)
+
+# find_complete_members()
+#_______________________________________________________________________________
+def find_complete_members(f, offset):
+    """Returns the offset just past the last complete gzip member in the
+    open file f, reading from the member that starts at offset. A member that
+    is still being written decompresses without errors, it just doesn't end.
+    """
+    f.seek(offset)
+    end = pos = offset
+    z = zlib.decompressobj(16+zlib.MAX_WBITS)
+    while True:
+        data = f.read(64*1024)
+        if not data:
+            break
+        while data:
+            try:
+                z.decompress(data)
+            except zlib.error, e:
+                raise ParseError('Corrupt gzip member at offset %d: %s' % (end, e))
+            if not z.unused_data:
+                pos += len(data)
+                break
+            pos += len(data) - len(z.unused_data)
+            end = pos
+            data = z.unused_data
+            z = zlib.decompressobj(16+zlib.MAX_WBITS)
+
+    if pos > end:
+        #if the last member ended exactly at the end of the file, more
+        #input is left unused
+        try:
+            z.decompress('\0')
+        except zlib.error:
+            pass
+        else:
+            if z.unused_data:
+                end = pos
+
+    return end
+
+# find_record_end()
+#_______________________________________________________________________________
+def find_record_end(f, offset):
+    """Returns the offset just past the gzip member, or the uncompressed WARC
+    or ARC record, that starts at offset in the open file f. Raises ParseError
+    if no record starts at offset.
+    """
+    f.seek(offset)
+    try:
+        if '\x1f\x8b' == f.read(2):
+            f.seek(offset)
+            pos = offset
+            z = zlib.decompressobj(16+zlib.MAX_WBITS)
+            while True:
+                data = f.read(64*1024)
+                if not data:
+                    return pos
+                z.decompress(data)
+                if z.unused_data:
+                    return pos + len(data) - len(z.unused_data)
+                pos += len(data)
+
+        f.seek(offset)
+        line = f.readline()
+        while '\n' == line:
+            line = f.readline()
+        if line.startswith('WARC/'):
+            length = 0
+            line = f.readline()
+            while line.strip():
+                name, _, value = line.partition(':')
+                if 'content-length' == name.strip().lower():
+                    length = int(value)
+                line = f.readline()
+            return f.tell() + length + 4 #the block is followed by two CRLFs
+        else:
+            #the last field of an arc header line is the record length. The arc
+            #parser reads the content a line at a time, so a record ends at the
+            #first newline at or after the end of its content
+            length = int(line.split()[-1])
+            if length <= 0:
+                return f.tell()
+            f.seek(length - 1, 1)
+            return f.tell() + len(f.readline())
+    except (zlib.error, ValueError, IndexError):
+        raise ParseError('No record at offset %d' % offset)
+
+# read_offsets()
+#_______________________________________________________________________________
+def read_offsets(f):
+    """Read 'offset [length]' lines from f, as given by --offsets-file.
+
+    >>> read_offsets(['100 2000', '', '5000'])
+    [(100, 2000), (5000, None)]
+    """
+    offsets = []
+    for line in f:
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) > 2:
+            raise ValueError('Expected offset and optional length, got: ' + line.strip())
+        length = int(fields[1]) if len(fields) > 1 else None
+        offsets.append((int(fields[0]), length))
+    return offsets
+
+# is_warc_record_at()
+#_______________________________________________________________________________
+def is_warc_record_at(f, offset):
+    """Returns True if a WARC record, gzipped or not, begins at offset in
+    the open file f.
+    """
+    f.seek(offset)
+    data = f.read(64*1024)
+    return data.startswith('WARC/') or is_warc_member(data)
+
+# find_member_boundaries()
+#_______________________________________________________________________________
+def find_member_boundaries(file, num_chunks):
+    """Returns up to num_chunks-1 offsets that split a gzip-per-record WARC
+    into roughly equal byte ranges, each offset being the start of a gzip
+    member. Returns None for files that can't be split (uncompressed files,
+    arc files, whose parser needs the filedesc record, or small files).
+    """
+    size = os.path.getsize(file)
+    f = open(file, 'rb')
+    try:
+        if not is_warc_member(f.read(64*1024)):
+            return None
+
+        boundaries = []
+        for i in range(1, num_chunks):
+            pos = max(size * i / num_chunks, boundaries[-1]+1 if boundaries else 1)
+            f.seek(pos)
+            while pos < size:
+                block = f.read(1024*1024 + 2)
+                j = block.find('\x1f\x8b\x08')
+                while j != -1:
+                    f.seek(pos+j)
+                    if is_warc_member(f.read(64*1024)):
+                        break
+                    j = block.find('\x1f\x8b\x08', j+1)
+                if j != -1:
+                    pos += j
+                    break
+                if len(block) <= 2:
+                    pos = size
+                    break
+                pos += len(block) - 2
+                f.seek(pos)
+
+            if pos >= size:
+                break
+            boundaries.append(pos)
+    finally:
+        f.close()
+
+    return boundaries or None
+
+
+# Batch mode
+#
+# Each worker process loads the exclude list once in init_batch_worker() and
+# reuses it for every file it indexes.
+#_______________________________________________________________________________
+batch_writer_options = None
+
+# init_batch_worker()
+#_______________________________________________________________________________
+def init_batch_worker(writer_options):
+    global batch_writer_options
+    batch_writer_options = dict(writer_options)
+
+    exclude_list  = batch_writer_options.pop('exclude_list', None)
+    exclude_index = batch_writer_options.pop('exclude_index', None)
+    if exclude_list:
+        if not os.path.exists(exclude_list):
+            raise IOError, "Exclude file not found"
+        if exclude_index:
+            batch_writer_options['exclude_list'] = ExcludeIndex.from_compiled(exclude_list, exclude_index)
+        else:
+            batch_writer_options['exclude_list'] = ExcludeIndex.from_file(exclude_list)
+
+# run_batch_job()
+#_______________________________________________________________________________
+def run_batch_job(job):
+    """Returns the input file, the worker's pid, the stats and None, or if
+    indexing failed, None and the error, so that one bad input doesn't stop
+    the batch.
+    """
+    input_file, output_file = job
+    start = time.time()
+    try:
+        cdx_writer = CDX_Writer(input_file, output_file, **batch_writer_options)
+        stats = cdx_writer.make_cdx()
+    except Exception, e:
+        return input_file, os.getpid(), None, traceback.format_exception_only(type(e), e)[-1].strip()
+    stats['seconds']   = time.time() - start
+    stats['num_bytes'] = os.path.getsize(input_file)
+    return input_file, os.getpid(), stats, None
+
+# index_files()
+#_______________________________________________________________________________
+def index_files(input_files, out_file=sys.stdout, output_dir=None, processes=None, stats_file=None, **writer_options):
+    """Index many files with a pool of worker processes.
+
+    If output_dir is set, each input file gets its own cdx file in output_dir,
+    named after the input file. Otherwise the cdx lines of all inputs are
+    written to out_file under a single header, in the order of input_files.
+
+    Inputs that fail to index are reported on stderr and in the stats, under
+    num_files_failed and the file's error, and left out of the output.
+    """
+    if stats_file and os.path.exists(stats_file):
+        raise IOError, "Stats file already exists"
+
+    tmp_dir = None
+    if output_dir:
+        ext = '.cdx' + OutputSink.compressions.get(writer_options.get('output_compression'), '')
+        output_files = [os.path.join(output_dir, os.path.basename(f) + ext) for f in input_files]
+        if len(set(output_files)) != len(output_files):
+            raise ValueError('Input files must have unique file names when using an output dir')
+    else:
+        #the per-file outputs are merged uncompressed, then compressed once
+        writer_options = dict(writer_options)
+        output_compression = writer_options.pop('output_compression', None)
+        tmp_dir = tempfile.mkdtemp(prefix='cdx_writer.')
+        output_files = [os.path.join(tmp_dir, '%06d.cdx' % i) for i in range(len(input_files))]
+
+    jobs = zip(input_files, output_files)
+    try:
+        if 1 == processes:
+            init_batch_worker(writer_options)
+            results = map(run_batch_job, jobs)
+        else:
+            pool = multiprocessing.Pool(processes, init_batch_worker, (writer_options,))
+            try:
+                results = pool.map(run_batch_job, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+
+        for input_file, pid, file_stats, error in results:
+            if error is not None:
+                sys.stderr.write('Failed to index %s: %s\n' % (input_file, error))
+        indexed = [output_file for (input_file, output_file), result in zip(jobs, results) if result[3] is None]
+
+        if tmp_dir is not None:
+            out_file = OutputSink(out_file, output_compression)
+            header = ' CDX ' + writer_options.get('format', 'N b a m s k r M S V g')
+            if writer_options.get('sort'):
+                #each output is already sorted, so merge them
+                files = [open(output_file, 'rb') for output_file in indexed]
+                for line in heapq.merge([header], *[read_sorted_run(f, skip_line=header) for f in files]):
+                    out_file.write(line + '\n')
+                for f in files:
+                    f.close()
+            else:
+                out_file.write(header + '\n')
+                for output_file in indexed:
+                    f = open(output_file, 'rb')
+                    f.readline() #skip header
+                    shutil.copyfileobj(f, out_file)
+                    f.close()
+            out_file.close()
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    stats = new_stats()
+    stats['files']   = {}
+    stats['workers'] = {}
+    stats['num_files_failed'] = 0
+    for input_file, pid, file_stats, error in results:
+        if error is not None:
+            stats['files'][input_file] = {'error': error}
+            stats['num_files_failed'] += 1
+            continue
+        stats['files'][input_file] = file_stats
+        add_stats(stats, file_stats)
+
+        worker = stats['workers'].setdefault(str(pid), {'num_files': 0, 'num_records': 0, 'num_bytes': 0, 'seconds': 0.0})
+        worker['num_files']   += 1
+        worker['num_records'] += file_stats['num_records_processed']
+        worker['num_bytes']   += file_stats['num_bytes']
+        worker['seconds']     += file_stats['seconds']
+
+    for worker in stats['workers'].itervalues():
+        seconds = max(worker['seconds'], 1e-6)
+        worker['records_per_sec'] = round(worker['num_records'] / seconds, 2)
+        worker['bytes_per_sec']   = round(worker['num_bytes'] / seconds, 2)
+
+    finish_stats(stats)
+    if stats_file is not None:
+        f = open(stats_file, 'w')
+        json.dump(stats, f, indent=4)
+        f.close()
+
+    return stats
+
+
+# Daemon mode
+#
+# IndexingDaemon keeps a pool of batch workers, each with the exclude list
+# loaded, and feeds it jobs from a unix socket or a spool directory. A job is a
+# json object with the input and output paths, an optional id and optional
+# options, which override the daemon's CDX_Writer options for that job.
+#_______________________________________________________________________________
+daemon_job_options = ['format', 'use_full_path', 'file_prefix', 'all_records', 'screenshot_mode',
+                      'stats_file', 'sort', 'sort_buffer_size', 'meta_tag_budget', 'verify_digests',
+                      'output_compression', 'surt_cache_size', 'dedup', 'dedup_index']
+
+class IndexingDaemon(object):
+    """Runs indexing jobs on a pool of worker processes, so interpreter
+    startup, imports and loading the exclude list are paid once per worker
+    rather than once per file.
+
+    Jobs sent to socket_path are json objects, one per line. A json result
+    line with the job's stats, or its error, is sent back on the same
+    connection as each job finishes. Jobs in spool_dir are files named
+    *.job, which are renamed to *.job.running while they run. The result is
+    written to *.job.done or *.job.failed.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, writer_options, processes=None, socket_path=None, spool_dir=None, poll_interval=5):
+        if socket_path is None and spool_dir is None:
+            raise ValueError('The daemon needs a socket or a spool directory to take jobs from')
+        self.socket_path   = socket_path
+        self.spool_dir     = spool_dir
+        self.poll_interval = poll_interval
+        self.pool   = multiprocessing.Pool(processes, init_daemon_worker, (writer_options,))
+        self.server = None
+
+    # run()
+    #___________________________________________________________________________
+    def run(self):
+        """Serve jobs until KeyboardInterrupt or SIGTERM, then wait for the
+        jobs that were already accepted.
+        """
+        signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+        try:
+            if self.socket_path is not None:
+                self.start_socket_server()
+            if self.spool_dir is not None:
+                self.requeue_spool_jobs()
+            while True:
+                if self.spool_dir is not None:
+                    self.poll_spool_dir()
+                time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    # submit()
+    #___________________________________________________________________________
+    def submit(self, job, callback):
+        """Queue job on the worker pool. callback is called with the result
+        dict, from the pool's result thread, once the job has finished.
+        """
+        error = check_daemon_job(job)
+        if error is not None:
+            result = {'id': job.get('id') if isinstance(job, dict) else None, 'status': 'failed', 'error': error}
+            callback(result)
+            return None
+        return self.pool.apply_async(run_daemon_job, (utf8_strings(job),), callback=callback)
+
+    # start_socket_server()
+    #___________________________________________________________________________
+    def start_socket_server(self):
+        if os.path.exists(self.socket_path):
+            #left behind by a daemon that was killed
+            os.unlink(self.socket_path)
+        self.server = SocketServer.ThreadingUnixStreamServer(self.socket_path, DaemonJobHandler)
+        self.server.daemon_threads  = True
+        self.server.indexing_daemon = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    # requeue_spool_jobs()
+    #___________________________________________________________________________
+    def requeue_spool_jobs(self):
+        """Jobs that were running when the previous daemon stopped are run
+        again.
+        """
+        for name in os.listdir(self.spool_dir):
+            if name.endswith('.job.running'):
+                path = os.path.join(self.spool_dir, name)
+                os.rename(path, path[:-len('.running')])
+
+    # poll_spool_dir()
+    #___________________________________________________________________________
+    def poll_spool_dir(self):
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith('.job'):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                os.rename(path, path + '.running')
+            except OSError:
+                continue #claimed by another daemon
+
+            f = open(path + '.running')
+            try:
+                job = json.load(f)
+            except ValueError, e:
+                finish_spool_job(path, {'id': None, 'status': 'failed', 'error': 'Invalid json: %s' % e})
+                continue
+            finally:
+                f.close()
+            self.submit(job, lambda result, path=path: finish_spool_job(path, result))
+
+    # close()
+    #___________________________________________________________________________
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            os.unlink(self.socket_path)
+            self.server = None
+        self.pool.close()
+        self.pool.join()
+
+
+class DaemonJobHandler(object):
+    """Reads json jobs from a connection, one per line, and writes a json
+    result line for each job when it finishes, in the order they finish. The
+    connection is closed after the client has shut down its side and the
+    results of all of its jobs have been sent.
+
+    SocketServer calls this class for each connection, like a subclass of
+    StreamRequestHandler, which isn't used so that SocketServer is only
+    imported in daemon mode.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, request, client_address, server):
+        self.server = server
+        self.rfile  = request.makefile('rb')
+        self.wfile  = request.makefile('wb', 0)
+        try:
+            self.handle()
+        finally:
+            self.rfile.close()
+            self.wfile.close()
+
+    # handle()
+    #___________________________________________________________________________
+    def handle(self):
+        daemon = self.server.indexing_daemon
+        lock = threading.Lock()
+        pending = []
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError, e:
+                self.send_result({'id': None, 'status': 'failed', 'error': 'Invalid json: %s' % e}, lock)
+                continue
+            result = daemon.submit(job, lambda result: self.send_result(result, lock))
+            if result is not None:
+                pending.append(result)
+        for result in pending:
+            result.wait()
+
+    # send_result()
+    #___________________________________________________________________________
+    def send_result(self, result, lock):
+        #runs on the pool's result thread, which must not die: it hands the
+        #results of all later jobs to their callbacks
+        lock.acquire()
+        try:
+            self.wfile.write(json.dumps(result) + '\n')
+        except socket.error:
+            pass #the client went away, the job has still been done
+        except Exception, e:
+            sys.stderr.write('Failed to send the result of job %r: %s\n' % (result.get('id'), e))
+        finally:
+            lock.release()
+
+
+# check_daemon_job()
+#_______________________________________________________________________________
+def check_daemon_job(job):
+    """Returns an error message if job isn't a valid daemon job.
+
+    >>> check_daemon_job({'input': 'a.warc.gz', 'output': 'a.cdx', 'options': {'all_records': True}})
+    >>> check_daemon_job({'input': 'a.warc.gz', 'output': 'a.cdx', 'options': {'processes': 4}})
+    'Unknown job option: processes'
+    """
+    if not isinstance(job, dict):
+        return 'A job must be a json object'
+    for key in ('input', 'output'):
+        if not isinstance(job.get(key), basestring):
+            return 'A job needs an %s path' % key
+    options = job.get('options', {})
+    if not isinstance(options, dict):
+        return 'Job options must be a json object'
+    for name in options:
+        if name not in daemon_job_options:
+            return 'Unknown job option: ' + name
+    return None
+
+# utf8_strings()
+#_______________________________________________________________________________
+def utf8_strings(value):
+    """Returns a value decoded by json with its unicode strings encoded as
+    utf-8, like the paths and options given on the command line.
+
+    >>> utf8_strings([u'N b a', {u'sort': True}, 3])
+    ['N b a', {'sort': True}, 3]
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [utf8_strings(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((utf8_strings(k), utf8_strings(v)) for k, v in value.iteritems())
+    return value
+
+# init_daemon_worker()
+#_______________________________________________________________________________
+def init_daemon_worker(writer_options):
+    #the daemon process handles ctrl-c and lets running jobs finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_batch_worker(writer_options)
+
+# run_daemon_job()
+#_______________________________________________________________________________
+def run_daemon_job(job):
+    result = {'id': job.get('id'), 'input': job['input'], 'output': job['output'], 'pid': os.getpid()}
+    options = dict(batch_writer_options)
+    options.update(job.get('options', {}))
+    start = time.time()
+    try:
+        cdx_writer = CDX_Writer(job['input'], job['output'], **options)
+        stats = cdx_writer.make_cdx()
+        stats['seconds']   = time.time() - start
+        stats['num_bytes'] = os.path.getsize(job['input'])
+        result['status'] = 'done'
+        result['stats']  = stats
+    except Exception, e:
+        result['status'] = 'failed'
+        result['error']  = traceback.format_exception_only(type(e), e)[-1].strip()
+    return result
+
+# finish_spool_job()
+#_______________________________________________________________________________
+def finish_spool_job(path, result):
+    #runs on the pool's result thread, which must not die: it hands the
+    #results of all later jobs to their callbacks
+    result_path = '%s.%s' % (path, result['status'])
+    try:
+        f = open(result_path + '.tmp', 'w')
+        json.dump(result, f, indent=4)
+        f.close()
+        os.rename(result_path + '.tmp', result_path)
+        os.unlink(path + '.running')
+    except Exception, e:
+        sys.stderr.write('Failed to finish spool job %s: %s\n' % (path, e))
+
+# raise_keyboard_interrupt()
+#_______________________________________________________________________________
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+# read_decompressed()
+#_______________________________________________________________________________
+def read_decompressed(f, chunk_size=1024*1024):
+    """Yields the contents of a plain, gzip or zstd compressed file in chunks.
+    Files made of many gzip members or zstd frames, like checkpointed or block
+    compressed cdx files, are read to the end.
+    """
+    magic = f.read(4)
+    f.seek(0)
+    if magic.startswith('\x1f\x8b'):
+        z = zlib.decompressobj(16+zlib.MAX_WBITS)
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            while data:
+                yield z.decompress(data)
+                #past the end of a member, input is left in unused_data
+                data = z.unused_data
+                if data:
+                    z = zlib.decompressobj(16+zlib.MAX_WBITS)
+    elif '\x28\xb5\x2f\xfd' == magic:
+        zstandard = import_zstandard()
+        if zstandard is None:
+            raise ValueError('Reading zstd compressed files requires the zstandard module')
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        while True:
+            data = reader.read(chunk_size)
+            if not data:
+                break
+            yield data
+    else:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+# read_cdx_lines()
+#_______________________________________________________________________________
+def read_cdx_lines(f):
+    """Yields the lines of a plain or compressed cdx file without their
+    newlines, skipping blank lines.
+    """
+    partial = ''
+    for data in read_decompressed(f):
+        lines = (partial + data).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if partial:
+        yield partial
+
+# check_sorted()
+#_______________________________________________________________________________
+def check_sorted(lines, name):
+    """Passes lines through, raising ValueError if they are out of order.
+
+    >>> list(check_sorted(['a 1', 'a 2', 'b'], 'test.cdx'))
+    ['a 1', 'a 2', 'b']
+    >>> list(check_sorted(['b', 'a'], 'test.cdx'))
+    Traceback (most recent call last):
+    ...
+    ValueError: test.cdx is not sorted, 'a' follows 'b'
+    """
+    prev = ''
+    for line in lines:
+        if line < prev:
+            raise ValueError('%s is not sorted, %r follows %r' % (name, line, prev))
+        prev = line
+        yield line
+
+# get_block_key()
+#_______________________________________________________________________________
+def get_block_key(line):
+    """Returns the first two fields of a cdx line, the url key and date with
+    the default format, which the summary index is searched by.
+
+    >>> get_block_key('org,archive)/ 20140314173216 https://archive.org/ text/html 200')
+    'org,archive)/ 20140314173216'
+    """
+    return ' '.join(line.split(' ', 2)[:2])
+
+# merge_cdx_files()
+#_______________________________________________________________________________
+def merge_cdx_files(input_files, out_file=sys.stdout, block_lines=3000, summary_file=None, output_compression=None, stats_file=None):
+    """Merge sorted cdx files, such as --sort output, into one sorted cdx.
+    Every input must have the same CDX header.
+
+    With block_lines, the output is ZipNum style: the header and then each run
+    of block_lines cdx lines are written as separate gzip members, and a line
+    of the summary file gives the first key, the output file name, the offset,
+    the length and the number of each block, separated by tabs. The summary is
+    sorted too, so a lookup can binary search it and inflate a single block.
+    Without block_lines, a plain sorted cdx is written, compressed with
+    output_compression if given.
+    """
+    if stats_file and os.path.exists(stats_file):
+        raise IOError, "Stats file already exists"
+    if block_lines:
+        if not isinstance(out_file, basestring):
+            raise ValueError('Block compressed output requires an output file')
+        if output_compression not in (None, 'gzip'):
+            raise ValueError('Block compressed output is always gzipped')
+        output_compression = 'gzip'
+        summary_file = summary_file or out_file + '.idx'
+
+    start = time.time()
+    files  = []
+    inputs = []
+    header = None
+    try:
+        for input_file in input_files:
+            f = open(input_file, 'rb')
+            files.append(f)
+            lines = read_cdx_lines(f)
+            input_header = next(lines, '')
+            if not input_header.startswith(' CDX '):
+                raise ValueError('%s has no CDX header' % input_file)
+            if header is None:
+                header = input_header
+            elif input_header.split() != header.split():
+                raise ValueError('%s has format %r, expected %r' % (input_file, input_header, header))
+            inputs.append(check_sorted(lines, input_file))
+
+        if header is None:
+            raise ValueError('No cdx files to merge')
+
+        out = OutputSink(out_file, output_compression)
+        summary = OutputSink(summary_file) if block_lines else None
+        try:
+            out.write(header + '\n')
+            merged = heapq.merge(*inputs)
+            num_lines  = 0
+            num_blocks = 0
+            if block_lines:
+                name   = os.path.basename(out_file)
+                offset = out.end_stream()
+                while True:
+                    block = list(itertools.islice(merged, block_lines))
+                    if not block:
+                        break
+                    out.write('\n'.join(block) + '\n')
+                    end = out.end_stream()
+                    num_lines  += len(block)
+                    num_blocks += 1
+                    summary.write('%s\t%s\t%d\t%d\t%d\n' % (get_block_key(block[0]), name, offset, end - offset, num_blocks))
+                    offset = end
+            else:
+                for line in merged:
+                    out.write(line + '\n')
+                    num_lines += 1
+        except:
+            out.abort()
+            if summary is not None:
+                summary.abort()
+            raise
+        out.close()
+        if summary is not None:
+            summary.close()
+    finally:
+        for f in files:
             f.close()
 
+    stats = {'num_files':  len(input_files),
+             'num_lines':  num_lines,
+             'num_blocks': num_blocks,
+             'seconds':    round(time.time() - start, 3),
+            }
+    if stats_file is not None:
+        f = open(stats_file, 'w')
+        json.dump(stats, f, indent=4)
+        f.close()
+
+    return stats
+
+
 # main()
 #_______________________________________________________________________________
 if __name__ == '__main__':
 
-    parser = OptionParser(usage="%prog [options] warc.gz [output_file.cdx]")
+    parser = OptionParser(usage="%prog [options] warc.gz [output_file.cdx]\n       %prog [options] --batch warc.gz [warc.gz ...]\n       %prog [options] --merge=index.cdx.gz file.cdx [file.cdx ...]\n       %prog [options] --daemon [--socket=PATH] [--spool-dir=DIR]")
     parser.set_defaults(format        = "N b a m s k r M S V g",
                         use_full_path = False,
                         file_prefix   = None,
                         all_records   = False,
                         screenshot_mode = False,
                         exclude_list    = None,
+                        exclude_index   = None,
+                        batch           = False,
+                        manifest        = None,
+                        output_dir      = None,
+                        processes       = None,
+                        sort            = False,
+                        sort_buffer_size = 100,
+                        meta_tag_budget = 1024*1024,
+                        verify_digests  = False,
+                        output_compression = None,
+                        profile         = False,
+                        surt_cache_size = 65536,
+                        checkpoint_interval = 0,
+                        resume          = False,
+                        follow          = False,
+                        follow_state    = None,
+                        poll_interval   = 5,
+                        offset          = None,
+                        length          = None,
+                        offsets_file    = None,
+                        merge           = None,
+                        block_lines     = None,
+                        summary_file    = None,
+                        dedup           = False,
+                        dedup_index     = None,
+                        daemon          = False,
+                        socket          = None,
+                        spool_dir       = None,
                        )
 
     parser.add_option("--format",  dest="format", help="A space-separated list of fields [default: '%default']")
@@ -732,10 +3320,146 @@ if __name__ == '__main__':
     parser.add_option("--all-records",   dest="all_records", action="store_true", help="By default we only index http responses. Use this flag to index all WARC records in the file")
     parser.add_option("--screenshot-mode", dest="screenshot_mode", action="store_true", help="Special Wayback Machine mode for handling WARCs containing screenshots")
     parser.add_option("--exclude-list", dest="exclude_list", help="File containing url prefixes to exclude")
+    parser.add_option("--exclude-index", dest="exclude_index", help="Compiled copy of --exclude-list, created if missing and rebuilt when the exclude list changes")
     parser.add_option("--stats-file", dest="stats_file", help="Output json file containing statistics")
+    parser.add_option("--batch", dest="batch", action="store_true", help="Index all input files given on the command line using a pool of worker processes")
+    parser.add_option("--manifest", dest="manifest", help="File listing input files to index, one per line. Implies --batch")
+    parser.add_option("--output-dir", dest="output_dir", help="In batch mode, write one cdx file per input into this directory instead of a single merged cdx on stdout")
+    parser.add_option("--processes", dest="processes", type="int", help="Number of worker processes. In batch mode this defaults to the number of cpus."
+                      " For a single gzipped WARC, values above 1 split the file at gzip member boundaries and index the pieces in parallel."
+                     )
+
+    parser.add_option("--sort", dest="sort", action="store_true", help="Sort the cdx output, in the same order as `LC_ALL=C sort`")
+    parser.add_option("--sort-buffer-size", dest="sort_buffer_size", type="int", help="Megabytes of cdx lines to hold in memory with --sort before spilling sorted runs to temp files [default: %default]")
+
+    parser.add_option("--meta-tag-budget", dest="meta_tag_budget", type="int", help="Number of bytes of an html document to search for meta tags if </head> or <body> is not found first [default: %default]")
+    parser.add_option("--verify-digests", dest="verify_digests", action="store_true", help="Check sha1 WARC-Payload-Digest headers against the record payloads and count mismatches in the stats file")
+    parser.add_option("--output-compression", dest="output_compression", choices=["gzip", "zstd"], help="Compress the cdx output with gzip or zstd. zstd requires the zstandard module")
+    parser.add_option("--surt-cache-size", dest="surt_cache_size", type="int", help="Number of recently seen urls whose surt is cached, 0 disables the cache [default: %default]")
+    parser.add_option("--checkpoint-interval", dest="checkpoint_interval", type="int", help="Every N records, save the input offset, output position and stats to OUTPUT_FILE.checkpoint, so an interrupted run can be continued with --resume")
+    parser.add_option("--resume", dest="resume", action="store_true", help="Continue an interrupted run from OUTPUT_FILE.checkpoint, or start from the beginning if there is no checkpoint")
+    parser.add_option("--follow-state", dest="follow_state", help="Index only the records appended to a gzipped WARC or ARC since the offset saved in this file by the previous run, then save the new offset")
+    parser.add_option("--follow", dest="follow", action="store_true", help="Keep indexing records as they are appended to the input, until it is removed or renamed. Saves offsets to --follow-state, or WARC_FILE.follow by default")
+    parser.add_option("--poll-interval", dest="poll_interval", type="float", help="Seconds between checks for new records with --follow, or for new jobs in --spool-dir [default: %default]")
+    parser.add_option("--profile", dest="profile", action="store_true", help="Record time spent and call counts for each stage of indexing in the stats file")
+    parser.add_option("--offset", dest="offset", type="int", help="Index only the record that starts at this byte offset, the V field of a cdx line")
+    parser.add_option("--length", dest="length", type="int", help="Length in bytes of the record at --offset, the S field of a cdx line. Found by reading the record if not given")
+    parser.add_option("--offsets-file", dest="offsets_file", help="Index only the records listed in this file, one 'offset [length]' per line")
+    parser.add_option("--dedup", dest="dedup", action="store_true", help="Count responses whose payload digest was already seen in the file, and the bytes they take up, in the stats file")
+    parser.add_option("--dedup-index", dest="dedup_index", help="Write the digest, date and url of the first capture of each payload to this file. Implies --dedup")
+    parser.add_option("--daemon", dest="daemon", action="store_true", help="Run indexing jobs from --socket or --spool-dir on a pool of --processes workers. The other options are the defaults for each job")
+    parser.add_option("--socket", dest="socket", help="Unix socket that the daemon reads json jobs from, one per line, and writes their results to")
+    parser.add_option("--spool-dir", dest="spool_dir", help="Directory that the daemon runs *.job files from, writing results to *.job.done or *.job.failed")
+    parser.add_option("--merge", dest="merge", help="Merge the sorted cdx files given on the command line into this file, '-' for stdout")
+    parser.add_option("--block-lines", dest="block_lines", type="int", help="With --merge, write gzip blocks of this many lines and a summary index of the blocks. 0 writes a plain sorted cdx [default: 3000, or 0 with --merge=-]")
+    parser.add_option("--summary-file", dest="summary_file", help="Summary index written by --merge, with the first key, offset and length of each block [default: MERGE.idx]")
 
     (options, input_files) = parser.parse_args(args=sys.argv[1:])
 
+    for name in ('meta_tag_budget', 'sort_buffer_size', 'surt_cache_size', 'checkpoint_interval', 'block_lines', 'offset', 'length'):
+        if getattr(options, name) is not None and getattr(options, name) < 0:
+            parser.error('--%s must not be negative' % name.replace('_', '-'))
+    if options.processes is not None and options.processes < 1:
+        parser.error('--processes must be at least 1')
+    if options.poll_interval <= 0:
+        parser.error('--poll-interval must be positive')
+
+    if options.daemon:
+        if input_files or not (options.socket or options.spool_dir):
+            parser.error('--daemon takes jobs from --socket or --spool-dir, not from the command line')
+        daemon = IndexingDaemon(dict(format          = options.format,
+                                     use_full_path   = options.use_full_path,
+                                     file_prefix     = options.file_prefix,
+                                     all_records     = options.all_records,
+                                     screenshot_mode = options.screenshot_mode,
+                                     exclude_list    = options.exclude_list,
+                                     exclude_index   = options.exclude_index,
+                                     sort            = options.sort,
+                                     sort_buffer_size = options.sort_buffer_size * 1024 * 1024,
+                                     meta_tag_budget = options.meta_tag_budget,
+                                     verify_digests  = options.verify_digests,
+                                     output_compression = options.output_compression,
+                                     profile         = options.profile,
+                                     surt_cache_size = options.surt_cache_size,
+                                     dedup           = options.dedup,
+                                    ),
+                                processes     = options.processes,
+                                socket_path   = options.socket,
+                                spool_dir     = options.spool_dir,
+                                poll_interval = options.poll_interval,
+                               )
+        daemon.run()
+        exit(0)
+
+    if options.merge:
+        if not input_files:
+            parser.print_help()
+            exit(-1)
+        if '-' == options.merge:
+            if options.block_lines:
+                parser.error('--block-lines needs an output file, --merge=- writes a plain sorted cdx')
+            options.block_lines = 0
+        elif options.block_lines is None:
+            options.block_lines = 3000
+        merge_cdx_files(input_files,
+                        out_file        = sys.stdout if '-' == options.merge else options.merge,
+                        block_lines     = options.block_lines,
+                        summary_file    = options.summary_file,
+                        output_compression = options.output_compression,
+                        stats_file      = options.stats_file,
+                       )
+        exit(0)
+
+    if (options.batch or options.manifest) and (options.checkpoint_interval or options.resume or options.follow or options.follow_state):
+        parser.error('--checkpoint-interval, --resume and follow mode index a single input file')
+
+    if (options.batch or options.manifest) and (options.offset is not None or options.offsets_file):
+        parser.error('--offset and --offsets-file index a single input file')
+
+    if (options.batch or options.manifest) and (options.dedup or options.dedup_index):
+        parser.error('--dedup and --dedup-index index a single input file')
+
+    if options.length is not None and options.offset is None:
+        parser.error('--length requires --offset')
+
+    offsets = None
+    if options.offset is not None:
+        offsets = [(options.offset, options.length)]
+    if options.offsets_file:
+        f = open(options.offsets_file)
+        offsets = (offsets or []) + read_offsets(f)
+        f.close()
+
+    if options.batch or options.manifest:
+        if options.manifest:
+            f = open(options.manifest)
+            input_files += [line.strip() for line in f if line.strip()]
+            f.close()
+        if not input_files:
+            parser.print_help()
+            exit(-1)
+
+        stats = index_files(input_files,
+                            output_dir      = options.output_dir,
+                            processes       = options.processes,
+                            stats_file      = options.stats_file,
+                            format          = options.format,
+                            use_full_path   = options.use_full_path,
+                            file_prefix     = options.file_prefix,
+                            all_records     = options.all_records,
+                            screenshot_mode = options.screenshot_mode,
+                            exclude_list    = options.exclude_list,
+                            exclude_index   = options.exclude_index,
+                            sort            = options.sort,
+                            sort_buffer_size = options.sort_buffer_size * 1024 * 1024,
+                            meta_tag_budget = options.meta_tag_budget,
+                            verify_digests  = options.verify_digests,
+                            output_compression = options.output_compression,
+                            profile         = options.profile,
+                            surt_cache_size = options.surt_cache_size,
+                           )
+        exit(1 if stats['num_files_failed'] else 0)
+
     if len(input_files) != 2:
         if len(input_files) == 1:
             input_files.append(sys.stdout)
@@ -751,5 +3475,22 @@ if __name__ == '__main__':
                             screenshot_mode = options.screenshot_mode,
                             exclude_list    = options.exclude_list,
                             stats_file      = options.stats_file,
+                            exclude_index   = options.exclude_index,
+                            processes       = options.processes or 1,
+                            sort            = options.sort,
+                            sort_buffer_size = options.sort_buffer_size * 1024 * 1024,
+                            meta_tag_budget = options.meta_tag_budget,
+                            verify_digests  = options.verify_digests,
+                            output_compression = options.output_compression,
+                            profile         = options.profile,
+                            surt_cache_size = options.surt_cache_size,
+                            checkpoint_interval = options.checkpoint_interval,
+                            resume          = options.resume,
+                            follow          = options.follow,
+                            follow_state    = options.follow_state,
+                            poll_interval   = options.poll_interval,
+                            offsets         = offsets,
+                            dedup           = options.dedup,
+                            dedup_index     = options.dedup_index,
                            )
     cdx_writer.make_cdx()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""Compare the cost of converting WARC-Date values with DateNormalizer against
+the datetime.strptime()/strftime() path that get_date() used before.
+
+Usage: PYTHONPATH=. ./bench_dates.py [num_dates]
+"""
+
+import sys
+import time
+import random
+from datetime import datetime
+
+sys.path.insert(0, '..')
+from cdx_writer import DateNormalizer
+
+# strptime_date()
+#_______________________________________________________________________________
+def strptime_date(date):
+    date = datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
+    return date.strftime("%Y%m%d%H%M%S")
+
+# make_dates()
+#_______________________________________________________________________________
+def make_dates(num_dates):
+    """Dates are clustered the way they are in a crawl: runs of records
+    captured in the same second, moving forward in time.
+    """
+    dates = []
+    t = time.mktime((2012, 1, 21, 17, 0, 0, 0, 0, 0))
+    while len(dates) < num_dates:
+        t += random.randint(0, 2)
+        date = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+        dates += [date] * random.randint(1, 20)
+    return dates[:num_dates]
+
+# bench()
+#_______________________________________________________________________________
+def bench(name, func, dates):
+    start = time.time()
+    for date in dates:
+        func(date)
+    elapsed = time.time() - start
+    print '%-24s %8.3fs  %10.0f dates/sec' % (name, elapsed, len(dates)/elapsed)
+    return elapsed
+
+
+if __name__ == '__main__':
+    num_dates = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    dates = make_dates(num_dates)
+
+    normalizer = DateNormalizer()
+    for date in dates[:1000]:
+        assert normalizer.convert(date) == strptime_date(date)
+
+    print 'converting %d clustered WARC-Date values' % num_dates
+    old = bench('strptime/strftime', strptime_date, dates)
+    new = bench('DateNormalizer.convert', DateNormalizer().convert, dates)
+    cached = bench('DateNormalizer.normalize', DateNormalizer().normalize, dates)
+    print 'speedup: %.1fx without cache, %.1fx with cache' % (old/new, old/cached)
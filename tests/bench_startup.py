@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""Measure the cold start of cdx_writer.py: the time from starting a new
+interpreter to reading the first cdx line of a small WARC from its stdout,
+and to the end of the run. Also times the import of cdx_writer and of each of
+its heavy dependencies in a fresh interpreter.
+
+Pass --script to time another copy of cdx_writer.py, e.g. an older checkout,
+for comparison.
+
+Usage: PYTHONPATH=. ./bench_startup.py [--runs N] [--script path/to/cdx_writer.py]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_warcs import make_warc
+
+
+modules = ['warctools', 'surt', 'chardet', 'hashlib', 'json', 'urlparse',
+           'datetime', 'tempfile', 'multiprocessing', 'SocketServer', 'zstandard']
+
+# time_run()
+#_______________________________________________________________________________
+def time_run(script, archive):
+    """Returns the seconds to the first cdx line and to the end of the run.
+    """
+    start = time.time()
+    p = subprocess.Popen([sys.executable, script, archive], stdout=subprocess.PIPE)
+    header = p.stdout.readline()
+    assert header.startswith(' CDX '), header
+    p.stdout.readline()
+    first_line = time.time() - start
+    p.stdout.read()
+    assert 0 == p.wait()
+    return first_line, time.time() - start
+
+# time_import()
+#_______________________________________________________________________________
+def time_import(module, path=None):
+    """Returns the seconds taken by importing module in a fresh interpreter,
+    or None if it isn't installed.
+    """
+    code = ('import sys, time\n'
+            'sys.path.insert(0, %r)\n'
+            'start = time.time()\n'
+            'try:\n'
+            '    import %s\n'
+            'except ImportError:\n'
+            '    sys.exit(1)\n'
+            'print time.time() - start\n') % (path or '', module)
+    p = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        return None
+    return float(out)
+
+# median()
+#_______________________________________________________________________________
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options]")
+    parser.set_defaults(runs=20, script=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cdx_writer.py'))
+    parser.add_option("--runs", dest="runs", type="int", help="Number of runs to take the min and median of [default: %default]")
+    parser.add_option("--script", dest="script", help="cdx_writer.py to time [default: %default]")
+    (options, args) = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='cdx_benchmark.')
+    try:
+        archive = os.path.join(tmp_dir, 'small.warc.gz')
+        make_warc(archive, 10, max_payload=4096)
+
+        time_run(options.script, archive) #warm the page cache
+        runs = [time_run(options.script, archive) for i in range(options.runs)]
+        first_lines = [run[0] for run in runs]
+        totals      = [run[1] for run in runs]
+        print '%-24s min %7.1f ms  median %7.1f ms' % ('first cdx line', 1000 * min(first_lines), 1000 * median(first_lines))
+        print '%-24s min %7.1f ms  median %7.1f ms' % ('whole run', 1000 * min(totals), 1000 * median(totals))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print
+    script_dir = os.path.dirname(os.path.abspath(options.script))
+    for module in ['cdx_writer'] + modules:
+        seconds = [time_import(module, script_dir) for i in range(5)]
+        if None in seconds:
+            print '%-24s not installed' % module
+        else:
+            print '%-24s import %7.1f ms' % (module, 1000 * min(seconds))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""Benchmark cdx_writer.py on synthetic WARC and ARC files.
+
+Each scenario generates an archive with synthetic_warcs.py, indexes it in a
+child process and reports records/sec, MB/sec, peak RSS and the time spent in
+each stage of indexing, as recorded by cdx_writer's --profile option: reading
+records, surt canonicalization, http header parsing, mime type detection, meta
+tag scanning, payload digests, output and so on. Whatever isn't covered by a
+stage is reported as other.
+
+Results are written as JSON. Pass --compare with an earlier results file to
+print the change in throughput per scenario; the exit status is 1 if any
+scenario got slower by more than --threshold percent.
+
+Usage: ./benchmark.py [--scale N] [--output results.json] [--compare old.json] [scenario ...]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import platform
+import traceback
+import multiprocessing
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+scenarios = [
+    {'name': 'warc-mixed', 'format': 'warc', 'records': 5000,
+     'options': {'revisit_fraction': 0.1, 'non_ascii_fraction': 0.05}},
+    {'name': 'warc-html-heads', 'format': 'warc', 'records': 5000,
+     'options': {'html_fraction': 1.0, 'meta_tag_fraction': 0.8, 'max_payload': 16*1024}},
+    {'name': 'warc-large-payloads', 'format': 'warc', 'records': 200,
+     'options': {'html_fraction': 0.0, 'min_payload': 1024*1024, 'max_payload': 4*1024*1024}},
+    {'name': 'warc-revisits', 'format': 'warc', 'records': 5000,
+     'options': {'revisit_fraction': 0.6, 'repeat_url_fraction': 0.7, 'max_payload': 8*1024}},
+    {'name': 'arc-non-ascii', 'format': 'arc', 'records': 5000,
+     'options': {'non_ascii_fraction': 0.3, 'latin1_fraction': 0.1, 'max_payload': 8*1024}},
+]
+
+# run_scenario()
+#_______________________________________________________________________________
+def run_scenario(archive, queue):
+    try:
+        queue.put(index_archive(archive))
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+# index_archive()
+#_______________________________________________________________________________
+def index_archive(archive):
+    out_file = open(os.devnull, 'wb')
+    writer   = cdx_writer.CDX_Writer(archive, out_file=out_file, all_records=True, profile=True)
+
+    start = time.time()
+    stats = writer.make_cdx()
+    seconds = time.time() - start
+    out_file.close()
+
+    stages = dict((stage, round(counts['seconds'], 4)) for stage, counts in stats['profile'].items())
+    stages['other'] = round(seconds - sum(counts['seconds'] for counts in stats['profile'].values()), 4)
+    return {'seconds': seconds,
+            'num_records': stats['num_records_processed'],
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'stages': stages,
+           }
+
+# bench()
+#_______________________________________________________________________________
+def bench(scenario, tmp_dir, scale):
+    ext = '.arc.gz' if 'arc' == scenario['format'] else '.warc.gz'
+    archive = os.path.join(tmp_dir, scenario['name'] + ext)
+    make = make_arc if 'arc' == scenario['format'] else make_warc
+    make(archive, int(scenario['records'] * scale), **scenario['options'])
+    num_bytes = os.path.getsize(archive)
+
+    #index in a child process, so peak rss belongs to this scenario alone
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run_scenario, args=(archive, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    os.unlink(archive)
+    if 'error' in result:
+        raise RuntimeError('indexing %s failed:\n%s' % (scenario['name'], result['error']))
+
+    seconds = result['seconds']
+    result.update({'name':           scenario['name'],
+                   'num_bytes':      num_bytes,
+                   'seconds':        round(seconds, 4),
+                   'records_per_sec': round(result['num_records'] / seconds, 1),
+                   'mb_per_sec':     round(num_bytes / seconds / (1024*1024), 3),
+                  })
+    return result
+
+# compare()
+#_______________________________________________________________________________
+def compare(results, old_results, threshold):
+    """Print the throughput change for each scenario found in both runs.
+    Returns True if any scenario regressed by more than threshold percent.
+    """
+    old = dict((r['name'], r) for r in old_results['scenarios'])
+    regressed = False
+    for result in results['scenarios']:
+        if result['name'] not in old:
+            continue
+        before = old[result['name']]['records_per_sec']
+        change = 100.0 * (result['records_per_sec'] - before) / before
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressed = True
+        print '%-22s %10.1f -> %10.1f records/sec  %+6.1f%%%s' % (result['name'], before, result['records_per_sec'], change, flag)
+    return regressed
+
+# print_result()
+#_______________________________________________________________________________
+def print_result(result):
+    print '%-22s %7d records %8.3fs %10.1f records/sec %8.2f MB/sec %8d KB peak rss' % (
+        result['name'], result['num_records'], result['seconds'], result['records_per_sec'],
+        result['mb_per_sec'], result['peak_rss_kb'])
+    stages = sorted(result['stages'].items(), key=lambda x: -x[1])
+    print ' ' * 22, '  '.join('%s %.3fs' % stage for stage in stages)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] [scenario ...]")
+    parser.set_defaults(scale=1.0, output=None, compare=None, threshold=10.0)
+    parser.add_option("--scale", dest="scale", type="float", help="Multiply the number of records in each scenario [default: %default]")
+    parser.add_option("--output", dest="output", help="Write results to this JSON file")
+    parser.add_option("--compare", dest="compare", help="Compare with results from an earlier --output file")
+    parser.add_option("--threshold", dest="threshold", type="float", help="Slowdown in percent reported as a regression [default: %default]")
+    (options, args) = parser.parse_args()
+
+    selected = [s for s in scenarios if not args or s['name'] in args]
+    if not selected:
+        parser.error('unknown scenario, choose from: ' + ', '.join(s['name'] for s in scenarios))
+
+    results = {'time':      time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+               'python':    platform.python_version(),
+               'platform':  platform.platform(),
+               'scale':     options.scale,
+               'scenarios': [],
+              }
+
+    tmp_dir = tempfile.mkdtemp(prefix='cdx_benchmark.')
+    try:
+        for scenario in selected:
+            result = bench(scenario, tmp_dir, options.scale)
+            print_result(result)
+            results['scenarios'].append(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(results, f, indent=4, sort_keys=True)
+        f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        old_results = json.load(f)
+        f.close()
+        if compare(results, old_results, options.threshold):
+            sys.exit(1)
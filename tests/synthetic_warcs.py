@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Generate synthetic WARC and ARC files for benchmarking cdx_writer.py.
+
+The files are gzipped per record, like crawler output. The mix of record types,
+payload sizes, html heads with meta tags, revisit records, duplicate payloads
+and non-ascii urls is controlled by the keyword arguments of make_warc() and
+make_arc(). Output is deterministic for a given seed.
+
+Usage: ./synthetic_warcs.py [--arc] [--records N] [--seed N] output_file
+"""
+
+import base64
+import gzip
+import hashlib
+import random
+import time
+from StringIO import StringIO
+from optparse import OptionParser
+
+
+hosts = ['www.example.com', 'archive.org', 'news.example.co.uk', 'blog.example.net',
+         'img.cdn.example.com', 'www.exemple.fr', 'example.jp']
+
+paths = ['/', '/index.html', '/robots.txt', '/about/', '/news/%d.html', '/img/%d.jpg',
+         '/search?q=%d&page=2', '/css/site.css', '/a/b/c/../d/%d']
+
+non_ascii_paths = [u'/école/%d', u'/検索?q=%d', u'/straße/%d.html', u'/новости/%d']
+
+#paths in the encodings of old crawls, which chardet has to guess, each on a
+#host of its own, as a site uses one charset
+legacy_paths = [(u'/école/%d', 'latin-1', 'www.example.fr'), (u'/新闻中心/%d', 'gb2312', 'www.example.cn'),
+                (u'/検索?q=%d', 'shift_jis', 'www.example.jp'), (u'/новости/%d', 'koi8-r', 'www.example.ru'),
+                (u'/뉴스/%d', 'euc-kr', 'www.example.kr')]
+
+mime_types = [('text/html', 0.5), ('image/jpeg', 0.2), ('text/css', 0.1),
+              ('application/javascript', 0.1), ('application/pdf', 0.1)]
+
+robots_values = ['noindex', 'nofollow', 'noarchive', 'noindex,nofollow', 'index,follow']
+
+
+# gzip_member()
+#_______________________________________________________________________________
+def gzip_member(data):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb', filename='', mtime=0)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+# sha1_base32()
+#_______________________________________________________________________________
+def sha1_base32(data):
+    return base64.b32encode(hashlib.sha1(data).digest())
+
+# choose()
+#_______________________________________________________________________________
+def choose(rng, weighted):
+    x = rng.random()
+    for value, weight in weighted:
+        x -= weight
+        if x < 0:
+            return value
+    return weighted[-1][0]
+
+
+class SyntheticRecords(object):
+    """Produces the urls, dates and http responses shared by the WARC and ARC
+    writers.
+    """
+
+    # init()
+    #___________________________________________________________________________
+    def __init__(self, seed=0, min_payload=200, max_payload=64*1024,
+                 html_fraction=None, meta_tag_fraction=0.3, non_ascii_fraction=0.05,
+                 repeat_url_fraction=0.2, duplicate_fraction=0.0, legacy_fraction=0.0):
+        self.rng                 = random.Random(seed)
+        self.min_payload         = min_payload
+        self.max_payload         = max_payload
+        self.html_fraction       = html_fraction
+        self.meta_tag_fraction   = meta_tag_fraction
+        self.non_ascii_fraction  = non_ascii_fraction
+        self.repeat_url_fraction = repeat_url_fraction
+        self.duplicate_fraction  = duplicate_fraction
+        self.legacy_fraction     = legacy_fraction
+        self.urls                = []
+        self.bodies              = []
+        self.time                = time.mktime((2012, 1, 21, 17, 0, 0, 0, 0, 0))
+
+    # next_url()
+    #___________________________________________________________________________
+    def next_url(self):
+        """Returns a utf-8 encoded url, or with legacy_fraction, a url in one
+        of the legacy_paths encodings. Some urls are repeated, as they would be
+        for robots.txt, revisits and dedup hits.
+        """
+        rng = self.rng
+        if self.urls and rng.random() < self.repeat_url_fraction:
+            return rng.choice(self.urls)
+
+        host = rng.choice(hosts)
+        n = rng.randint(0, 100000)
+        if self.legacy_fraction and rng.random() < self.legacy_fraction:
+            path, encoding, host = rng.choice(legacy_paths)
+            path = (path % n).encode(encoding)
+        elif rng.random() < self.non_ascii_fraction:
+            path = (rng.choice(non_ascii_paths) % n).encode('utf-8')
+        else:
+            path = rng.choice(paths)
+            if '%d' in path:
+                path = path % n
+        url = rng.choice(['http://', 'https://']) + host + path
+        self.urls.append(url)
+        return url
+
+    # next_date()
+    #___________________________________________________________________________
+    def next_date(self):
+        """Crawl timestamps are clustered, several records share a second.
+        """
+        self.time += self.rng.choice([0, 0, 0, 1, 2])
+        return time.gmtime(self.time)
+
+    # next_mime_type()
+    #___________________________________________________________________________
+    def next_mime_type(self):
+        if self.html_fraction is not None:
+            if self.rng.random() < self.html_fraction:
+                return 'text/html'
+            return 'image/jpeg'
+        return choose(self.rng, mime_types)
+
+    # make_body()
+    #___________________________________________________________________________
+    def make_body(self, mime_type):
+        rng = self.rng
+        size = int(rng.uniform(self.min_payload, self.max_payload))
+        if 'text/html' != mime_type:
+            return ''.join(chr(rng.randint(0, 255)) for i in xrange(min(size, 256))) * (size / 256 + 1)
+
+        head = ['<html><head><title>synthetic page</title>']
+        if rng.random() < self.meta_tag_fraction:
+            head.append('<meta name="robots" content="%s">' % rng.choice(robots_values))
+        head.append('<meta http-equiv="Content-Type" content="text/html; charset=utf-8">')
+        head.append('<link rel="stylesheet" href="/css/site.css"></head><body>')
+        body = ''.join(head)
+        filler = '<p>lorem ipsum dolor sit amet <a href="/news/%d.html">link</a></p>\n'
+        while len(body) < size:
+            body += filler % rng.randint(0, 100000)
+        return body + '</body></html>\n'
+
+    # make_http_response()
+    #___________________________________________________________________________
+    def make_http_response(self):
+        """Some payloads are repeated, as they would be for a crawl that
+        wasn't deduplicated.
+        """
+        mime_type = self.next_mime_type()
+        status = choose(self.rng, [('200 OK', 0.85), ('404 Not Found', 0.05),
+                                   ('301 Moved Permanently', 0.05), ('500 Internal Server Error', 0.05)])
+        if self.duplicate_fraction and self.bodies and self.rng.random() < self.duplicate_fraction:
+            mime_type, body = self.rng.choice(self.bodies)
+        else:
+            body = self.make_body(mime_type)
+            if self.duplicate_fraction:
+                self.bodies.append((mime_type, body))
+        headers = ('HTTP/1.1 %s\r\n'
+                   'Server: synthetic\r\n'
+                   'Content-Type: %s\r\n'
+                   'Content-Length: %d\r\n'
+                   'Connection: close\r\n') % (status, mime_type, len(body))
+        if self.rng.random() < 0.05:
+            headers += 'X-Robots-Tag: noarchive\r\n'
+        return mime_type, headers + '\r\n' + body, body
+
+
+# warc_record()
+#_______________________________________________________________________________
+def warc_record(warc_type, date, block, url=None, content_type=None, extra_headers=()):
+    headers = ['WARC/1.0',
+               'WARC-Type: ' + warc_type,
+               'WARC-Record-ID: <urn:uuid:%s>' % hashlib.md5((url or '') + block[:64]).hexdigest(),
+               'WARC-Date: ' + time.strftime('%Y-%m-%dT%H:%M:%SZ', date)]
+    if url:
+        headers.append('WARC-Target-URI: ' + url)
+    if content_type:
+        headers.append('Content-Type: ' + content_type)
+    headers += list(extra_headers)
+    headers.append('Content-Length: %d' % len(block))
+    return '\r\n'.join(headers) + '\r\n\r\n' + block + '\r\n\r\n'
+
+# make_warc()
+#_______________________________________________________________________________
+def make_warc(path, num_records=1000, seed=0, revisit_fraction=0.1, request_fraction=0.0,
+              compress=True, **kwargs):
+    """Write a WARC with num_records records after the warcinfo record.
+    Returns the number of records written.
+    """
+    records = SyntheticRecords(seed, **kwargs)
+    rng = records.rng
+    pack = gzip_member if compress else (lambda data: data)
+    digests = {}
+
+    f = open(path, 'wb')
+    info = 'software: synthetic_warcs.py\r\nformat: WARC File Format 1.0\r\n'
+    f.write(pack(warc_record('warcinfo', records.next_date(), info, content_type='application/warc-fields')))
+
+    for i in xrange(num_records):
+        url  = records.next_url()
+        date = records.next_date()
+        x = rng.random()
+        if x < revisit_fraction and url in digests:
+            block = 'HTTP/1.1 200 OK\r\nServer: synthetic\r\n\r\n'
+            f.write(pack(warc_record('revisit', date, block, url, 'application/http; msgtype=response',
+                                     ['WARC-Profile: http://netpreserve.org/warc/1.0/revisit/identical-payload-digest',
+                                      'WARC-Payload-Digest: sha1:' + digests[url]])))
+        elif x < revisit_fraction + request_fraction:
+            block = 'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+            f.write(pack(warc_record('request', date, block, url, 'application/http; msgtype=request')))
+        else:
+            mime_type, block, body = records.make_http_response()
+            digests[url] = sha1_base32(body)
+            f.write(pack(warc_record('response', date, block, url, 'application/http; msgtype=response',
+                                     ['WARC-Payload-Digest: sha1:' + digests[url]])))
+    f.close()
+    return num_records + 1
+
+# make_arc()
+#_______________________________________________________________________________
+def make_arc(path, num_records=1000, seed=0, compress=True, latin1_fraction=0.05, **kwargs):
+    """Write a version 1 ARC file. Some urls contain raw latin-1 bytes, like
+    the 2002-2004 arc files that need chardet.
+    """
+    records = SyntheticRecords(seed, **kwargs)
+    rng = records.rng
+    pack = gzip_member if compress else (lambda data: data)
+
+    f = open(path, 'wb')
+    date = records.next_date()
+    content = '1 0 synthetic\nURL IP-address Archive-date Content-type Archive-length\n'
+    f.write(pack('filedesc://%s 0.0.0.0 %s text/plain %d\n%s\n' % (path.split('/')[-1], time.strftime('%Y%m%d%H%M%S', date), len(content), content)))
+
+    for i in xrange(num_records):
+        url = records.next_url()
+        if rng.random() < latin1_fraction:
+            url = 'http://%s/s%%c3l%d/%s' % (rng.choice(hosts), i, u'\xe9cole'.encode('latin-1'))
+        date = time.strftime('%Y%m%d%H%M%S', records.next_date())
+        mime_type, block, body = records.make_http_response()
+        f.write(pack('%s 10.0.0.1 %s %s %d\n%s\n' % (url, date, mime_type, len(block), block)))
+    f.close()
+    return num_records + 1
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] output_file")
+    parser.set_defaults(arc=False, records=1000, seed=0)
+    parser.add_option("--arc", dest="arc", action="store_true", help="Write an ARC file instead of a WARC")
+    parser.add_option("--records", dest="records", type="int", help="Number of records [default: %default]")
+    parser.add_option("--seed", dest="seed", type="int", help="Random seed [default: %default]")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        exit(-1)
+
+    if options.arc:
+        make_arc(args[0], options.records, options.seed)
+    else:
+        make_warc(args[0], options.records, options.seed)
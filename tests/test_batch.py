@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""Index several fixtures and a file that isn't an archive with --batch, and
+check that each input's cdx lines are the same as a single-file run, and that
+the bad input is reported without stopping the others.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+fixtures = ['wget_ia.warc.gz', 'password-protected.warc.gz', 'meta_tag_I.arc.gz',
+            'non_ascii_url.arc.gz', 'uncompressed.arc']
+
+tests = [
+    {'output_dir': True},
+    {'output_dir': False},
+    {'output_dir': False, 'processes': 1},
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    inputs = [os.path.abspath(f) for f in fixtures]
+    inputs.append(os.path.join(tmp_dir, 'synthetic.warc.gz'))
+    make_warc(inputs[-1], 200, non_ascii_fraction=0.2, max_payload=4096)
+    inputs.append(os.path.join(tmp_dir, 'synthetic.arc.gz'))
+    make_arc(inputs[-1], 200, latin1_fraction=0.2, max_payload=4096)
+    bad = os.path.join(tmp_dir, 'bad.warc.gz')
+    f = open(bad, 'w')
+    f.write('this is not an archive\n')
+    f.close()
+    inputs.insert(3, bad)
+
+    expected = {}
+    for input_file in inputs:
+        if input_file != bad:
+            output = os.path.join(tmp_dir, 'expected.cdx')
+            cdx_writer.CDX_Writer(input_file, output, all_records=True).make_cdx()
+            expected[input_file] = open(output, 'rb').read()
+            os.unlink(output)
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test
+        output_dir = os.path.join(tmp_dir, 'output')
+        stats_file = os.path.join(tmp_dir, 'stats.json')
+        os.mkdir(output_dir)
+
+        cmd = [sys.executable, '../cdx_writer.py', '--batch', '--all-records', '--stats-file=' + stats_file,
+               '--processes=%d' % test.get('processes', 3)]
+        if test['output_dir']:
+            cmd.append('--output-dir=' + output_dir)
+        p = subprocess.Popen(cmd + inputs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        assert 1 == p.returncode, p.returncode
+        assert 'Failed to index %s' % bad in err, err
+
+        if test['output_dir']:
+            assert '' == out
+            assert sorted(os.listdir(output_dir)) == sorted(os.path.basename(f) + '.cdx' for f in expected)
+            for input_file, cdx in expected.iteritems():
+                assert open(os.path.join(output_dir, os.path.basename(input_file) + '.cdx'), 'rb').read() == cdx, input_file
+        else:
+            lines = [' CDX N b a m s k r M S V g\n']
+            for input_file in inputs:
+                if input_file != bad:
+                    lines += expected[input_file].splitlines(True)[1:]
+            assert out == ''.join(lines), "merged output differs"
+
+        stats = json.load(open(stats_file))
+        assert 1 == stats['num_files_failed']
+        assert 'error' in stats['files'][bad]
+        for input_file, cdx in expected.iteritems():
+            assert stats['files'][input_file]['num_records_included'] == len(cdx.splitlines()) - 1, input_file
+        assert stats['num_records_included'] == sum(len(cdx.splitlines()) - 1 for cdx in expected.itervalues())
+
+        shutil.rmtree(output_dir)
+        os.unlink(stats_file)
+        test_num += 1
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
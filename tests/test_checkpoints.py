@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""Interrupt checkpointed runs part way through and check that --resume
+produces the same output as an uninterrupted run.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+class InterruptedWriter(cdx_writer.CDX_Writer):
+    """Raises KeyboardInterrupt when it gets to record number stop_at."""
+    stop_at = None
+
+    def get_massaged_url(self, record, use_precalculated_value=True):
+        if not use_precalculated_value and self.stats['num_records_processed'] == self.stop_at:
+            raise KeyboardInterrupt
+        return cdx_writer.CDX_Writer.get_massaged_url(self, record, use_precalculated_value)
+
+
+tests = [
+    {'file': 'test.warc.gz', 'stop_at': 77,  'interval': 10},
+    {'file': 'test.warc.gz', 'stop_at': 77,  'interval': 10, 'output_compression': 'gzip'},
+    {'file': 'test.warc',    'stop_at': 150, 'interval': 25},
+    {'file': 'test.arc.gz',  'stop_at': 120, 'interval': 50},
+    {'file': 'test.arc',     'stop_at': 120, 'interval': 50},
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    make_warc(os.path.join(tmp_dir, 'test.warc.gz'), 200, non_ascii_fraction=0.2, max_payload=4096)
+    make_warc(os.path.join(tmp_dir, 'test.warc'), 200, compress=False, max_payload=4096)
+    make_arc(os.path.join(tmp_dir, 'test.arc.gz'), 200, non_ascii_fraction=0.2, latin1_fraction=0.2, max_payload=4096)
+    make_arc(os.path.join(tmp_dir, 'test.arc'), 200, compress=False, max_payload=4096)
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test['file']
+        archive  = os.path.join(tmp_dir, test['file'])
+        expected = os.path.join(tmp_dir, 'expected.cdx')
+        output   = os.path.join(tmp_dir, 'output.cdx')
+        options  = {'all_records': True, 'output_compression': test.get('output_compression')}
+
+        #compressed output starts a new gzip member at each checkpoint
+        stats = cdx_writer.CDX_Writer(archive, expected, checkpoint_interval=test['interval'], **options).make_cdx()
+
+        writer = InterruptedWriter(archive, output, checkpoint_interval=test['interval'], **options)
+        writer.stop_at = test['stop_at']
+        try:
+            writer.make_cdx()
+            assert False, "run wasn't interrupted"
+        except KeyboardInterrupt:
+            pass
+        assert not os.path.exists(output)
+        assert os.path.exists(output + '.partial')
+        assert os.path.exists(output + '.checkpoint')
+
+        resumed_stats = cdx_writer.CDX_Writer(archive, output, resume=True, **options).make_cdx()
+        assert open(output, 'rb').read() == open(expected, 'rb').read(), "resumed output differs"
+        assert resumed_stats['num_records_processed'] == stats['num_records_processed']
+        assert resumed_stats['num_records_included'] == stats['num_records_included']
+        assert not os.path.exists(output + '.partial')
+        assert not os.path.exists(output + '.checkpoint')
+
+        os.unlink(output)
+        os.unlink(expected)
+        test_num += 1
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
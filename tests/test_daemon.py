@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""Run cdx_writer.py --daemon, send it jobs over its socket and spool
+directory, and check the results against indexing each file directly.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc
+
+
+# wait_for()
+#_______________________________________________________________________________
+def wait_for(condition, seconds=60):
+    for i in range(seconds * 10):
+        if condition():
+            return
+        time.sleep(0.1)
+    assert False, "timed out"
+
+# send_jobs()
+#_______________________________________________________________________________
+def send_jobs(socket_path, lines):
+    s = socket.socket(socket.AF_UNIX)
+    s.connect(socket_path)
+    s.sendall(''.join(line + '\n' for line in lines))
+    s.shutdown(socket.SHUT_WR)
+    data = ''
+    while True:
+        chunk = s.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    s.close()
+    return dict((r['id'], r) for r in map(json.loads, data.splitlines()))
+
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    spool_dir   = os.path.join(tmp_dir, 'spool')
+    socket_path = os.path.join(tmp_dir, 'daemon.sock')
+    os.mkdir(spool_dir)
+    for i in range(3):
+        make_warc(os.path.join(tmp_dir, 'test%d.warc.gz' % i), 200, seed=i, max_payload=4096)
+
+    daemon_log = open(os.path.join(tmp_dir, 'daemon.log'), 'w')
+    daemon = subprocess.Popen([sys.executable, '../cdx_writer.py', '--daemon', '--processes=2', '--all-records',
+                               '--socket=' + socket_path, '--spool-dir=' + spool_dir, '--poll-interval=0.1'],
+                              stderr=daemon_log)
+    try:
+        wait_for(lambda: os.path.exists(socket_path))
+
+        print "processing # 0 socket"
+        jobs = [{'id': i, 'input': os.path.join(tmp_dir, 'test%d.warc.gz' % i), 'output': os.path.join(tmp_dir, 'test%d.cdx' % i)} for i in range(3)]
+        jobs.append({'id': 'sorted', 'input': jobs[0]['input'], 'output': os.path.join(tmp_dir, 'sorted.cdx'), 'options': {'sort': True, 'format': 'N b a'}})
+        jobs.append({'id': 'missing', 'input': os.path.join(tmp_dir, 'missing.warc.gz'), 'output': os.path.join(tmp_dir, 'missing.cdx')})
+        jobs.append({'id': 'bad option', 'input': jobs[0]['input'], 'output': os.path.join(tmp_dir, 'bad.cdx'), 'options': {'processes': 4}})
+        results = send_jobs(socket_path, [json.dumps(job) for job in jobs] + ['not json'])
+
+        assert len(results) == len(jobs) + 1
+        for i in range(3):
+            assert 'done' == results[i]['status']
+            expected = os.path.join(tmp_dir, 'expected.cdx')
+            stats = cdx_writer.CDX_Writer(jobs[i]['input'], expected, all_records=True).make_cdx()
+            assert open(jobs[i]['output'], 'rb').read() == open(expected, 'rb').read()
+            assert results[i]['stats']['num_records_included'] == stats['num_records_included']
+            os.unlink(expected)
+        assert 'done' == results['sorted']['status']
+        assert ' CDX N b a' == open(os.path.join(tmp_dir, 'sorted.cdx')).readline().rstrip()
+        assert 'failed' == results['missing']['status']
+        assert 'failed' == results['bad option']['status']
+        assert 'failed' == results[None]['status']
+
+        print "processing # 1 spool dir"
+        f = open(os.path.join(spool_dir, 'first.job.tmp'), 'w')
+        json.dump({'input': jobs[2]['input'], 'output': os.path.join(tmp_dir, 'spooled.cdx')}, f)
+        f.close()
+        os.rename(os.path.join(spool_dir, 'first.job.tmp'), os.path.join(spool_dir, 'first.job'))
+        f = open(os.path.join(spool_dir, 'second.job'), 'w')
+        f.write('{"input": ')
+        f.close()
+
+        wait_for(lambda: sorted(os.listdir(spool_dir)) == ['first.job.done', 'second.job.failed'])
+        result = json.load(open(os.path.join(spool_dir, 'first.job.done')))
+        assert 'done' == result['status']
+        assert open(os.path.join(tmp_dir, 'spooled.cdx'), 'rb').read() == open(jobs[2]['output'], 'rb').read()
+
+        print "processing # 2 spool job whose result can't be written"
+        #a directory in the way of the result file makes the rename fail
+        os.mkdir(os.path.join(spool_dir, 'blocked.job.done'))
+        for name in ('blocked', 'third'):
+            f = open(os.path.join(spool_dir, name + '.job'), 'w')
+            json.dump({'input': jobs[1]['input'], 'output': os.path.join(tmp_dir, name + '.cdx')}, f)
+            f.close()
+            wait_for(lambda: os.path.exists(os.path.join(tmp_dir, name + '.cdx')))
+        #later jobs still finish
+        wait_for(lambda: os.path.exists(os.path.join(spool_dir, 'third.job.done')))
+        assert os.path.exists(os.path.join(spool_dir, 'blocked.job.running'))
+        assert 'Failed to finish spool job %s' % os.path.join(spool_dir, 'blocked.job') in open(daemon_log.name).read()
+    finally:
+        daemon.terminate()
+        try:
+            wait_for(lambda: daemon.poll() is not None)
+        finally:
+            if daemon.poll() is None:
+                daemon.kill()
+        assert 0 == daemon.returncode
+        daemon_log.close()
+    assert not os.path.exists(socket_path)
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
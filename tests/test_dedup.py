@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+"""Index synthetic archives with repeated payloads using --dedup-index and
+check the duplicate counts and the digest index against the cdx output.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from StringIO import StringIO
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+tests = [
+    {'file': 'test.warc.gz'},
+    {'file': 'test.arc.gz'},
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    make_warc(os.path.join(tmp_dir, 'test.warc.gz'), 300, revisit_fraction=0.1, duplicate_fraction=0.3, max_payload=4096)
+    make_arc(os.path.join(tmp_dir, 'test.arc.gz'), 300, duplicate_fraction=0.3, latin1_fraction=0.1, max_payload=4096)
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test['file']
+        archive     = os.path.join(tmp_dir, test['file'])
+        output      = os.path.join(tmp_dir, 'output.cdx')
+        stats_file  = os.path.join(tmp_dir, 'stats.json')
+        dedup_index = os.path.join(tmp_dir, 'digests.cdx')
+
+        cdx_writer.CDX_Writer(archive, output, stats_file=stats_file, dedup_index=dedup_index, profile=True).make_cdx()
+        stats = json.load(open(stats_file))
+
+        first_captures = {}
+        num_duplicates = 0
+        duplicate_bytes = 0
+        for line in open(output, 'rb').read().splitlines()[1:]:
+            url_key, date, url, mime_type, code, digest, redirect, meta_tags, size, offset, name = line.split(' ')
+            if 'warc/revisit' == mime_type:
+                continue
+            if digest in first_captures:
+                num_duplicates += 1
+                duplicate_bytes += int(size)
+            else:
+                first_captures[digest] = '%s %s %s' % (digest, date, url)
+
+        assert num_duplicates > 0
+        assert stats['num_duplicate_payloads'] == num_duplicates
+        assert stats['duplicate_payload_bytes'] == duplicate_bytes
+        assert stats['num_unique_payloads'] == len(first_captures)
+
+        lines = open(dedup_index, 'rb').read().splitlines()
+        assert ' CDX k b a' == lines[0]
+        assert lines[1:] == sorted(first_captures.values())
+
+        #the digest index reuses the urls of the cdx lines, they aren't decoded again
+        plain_stats = cdx_writer.CDX_Writer(archive, StringIO(), profile=True).make_cdx()
+        for name in ('num_urls_decoded_utf8', 'num_urls_decoded_by_host', 'num_urls_decoded_chardet'):
+            assert stats[name] == plain_stats[name], (name, stats[name], plain_stats[name])
+        assert stats['profile']['get_original_url']['calls'] == plain_stats['profile']['get_original_url']['calls'] == stats['num_records_included']
+
+        for path in (output, stats_file, dedup_index):
+            os.unlink(path)
+        test_num += 1
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
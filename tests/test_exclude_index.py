@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""Check when a compiled --exclude-index is reused and when it is rebuilt: it
+is reused while the exclude list is unchanged, also after the list is only
+touched, and rebuilt when its contents change.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, '..')
+import cdx_writer
+from surt import surt
+
+
+# write_list()
+#_______________________________________________________________________________
+def write_list(path, urls, mtime):
+    f = open(path, 'w')
+    f.write(''.join(url + '\n' for url in urls))
+    f.close()
+    os.utime(path, (mtime, mtime))
+
+# load_index()
+#_______________________________________________________________________________
+def load_index(exclude_list, index_file):
+    """Returns the index and the number of times the exclude list was hashed.
+    """
+    calls = []
+    get_source_sha1 = cdx_writer.ExcludeIndex.get_source_sha1
+    def counting_sha1(exclude_list):
+        calls.append(exclude_list)
+        return get_source_sha1(exclude_list)
+    cdx_writer.ExcludeIndex.get_source_sha1 = staticmethod(counting_sha1)
+    try:
+        index = cdx_writer.ExcludeIndex.from_compiled(exclude_list, index_file)
+    finally:
+        cdx_writer.ExcludeIndex.get_source_sha1 = staticmethod(get_source_sha1)
+    return index, len(calls)
+
+
+urls  = ['http://www.example.com/private/', 'http://archive.org/details/x', 'http://example.jp/']
+other = ['http://www.example.com/privatf/', 'http://archive.org/details/x', 'http://example.jp/']
+
+# (step, urls of the list or None to keep it, new mtime, expect cached, expected hashes)
+tests = [
+    ('new index',          urls,  1000000000, False, 1), #hashed by save()
+    ('unchanged',          None,  None,       True,  0),
+    ('touched',            None,  1000000100, True,  1),
+    ('touched, reused',    None,  None,       True,  0),
+    ('same size, changed', other, 1000000200, False, 2), #hashed by load() and save()
+    ('size changed',       urls[:2], 1000000300, False, 2),
+    ('rebuilt, reused',    None,  None,       True,  0),
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    exclude_list = os.path.join(tmp_dir, 'excludes.txt')
+    index_file   = os.path.join(tmp_dir, 'excludes.idx')
+    current = None
+
+    test_num = 0
+    for step, new_urls, mtime, cached, hashes in tests:
+        print "processing #", test_num, step
+        if new_urls is not None:
+            current = new_urls
+            write_list(exclude_list, current, mtime)
+        elif mtime is not None:
+            os.utime(exclude_list, (mtime, mtime))
+
+        index, num_hashes = load_index(exclude_list, index_file)
+        assert index.cached == cached, (index.cached, cached)
+        assert num_hashes == hashes, (num_hashes, hashes)
+        assert len(index) == len(current)
+        for url in urls + other:
+            assert index.matches(surt(url + 'page.html')) == (url in current), url
+
+        #the header holds the mtime and size of the list it now stands for
+        f = open(index_file, 'rb')
+        header = cdx_writer.ExcludeIndex.header.unpack(f.read(cdx_writer.ExcludeIndex.header.size))
+        f.close()
+        st = os.stat(exclude_list)
+        assert header[1:3] == (st.st_mtime, st.st_size)
+        test_num += 1
+
+    assert ['excludes.idx', 'excludes.txt'] == sorted(os.listdir(tmp_dir))
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
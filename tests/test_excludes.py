@@ -35,6 +35,17 @@ filedesc://51_23_20110804181044_crawl101.arc.gz 20110804181044 filedesc://51_23_
 com,monsterindia,jobs)/details/9660976.html 20110804181044 http://jobs.monsterindia.com:80/details/9660976.html text/html 200 BQJDX42R5GFX4OIXPGNHZG3QFM5X3KQR - - 51406 79332 uncompressed.arc
 """,
         'num_filtered': 2,
+    },
+    {
+        'file': 'uncompressed.arc',
+        'exclude': 'http://art.rolo.vn/a/chi-tiet/\nhttp://art.rolo.vn/\nhttp://art.rolo.vn/a/', #redundant prefixes are collapsed
+        'result' : """ CDX N b a m s k r M S V g
+filedesc://51_23_20110804181044_crawl101.arc.gz 20110804181044 filedesc://51_23_20110804181044_crawl101.arc.gz warc/filedesc - 3I42H3S6NNFQ2MSVX7XZKYAYSCX5QBYJ - - 161 0 uncompressed.arc
+de,sueddeutsche)/muenchen/manu-chao-in-muenchen-che-guitarra-1.1114509-2 20110804181044 http://www.sueddeutsche.de:80/muenchen/manu-chao-in-muenchen-che-guitarra-1.1114509-2 text/html 200 ZMBIXCVTXG2CNEFAZI753FJUXJUQSI2M - A 78939 392 uncompressed.arc
+com,monsterindia,jobs)/details/9660976.html 20110804181044 http://jobs.monsterindia.com:80/details/9660976.html text/html 200 BQJDX42R5GFX4OIXPGNHZG3QFM5X3KQR - - 51406 79332 uncompressed.arc
+""",
+        'num_filtered': 1,
+        'exclude_index_size': 1,
     }
 ]
 
@@ -64,6 +75,8 @@ for test in tests:
     stats = json.load(stats_fh)
     stats_fh.close()
     assert stats['num_records_filtered'] == test['num_filtered'], "Wrong number of records were filtered! expected %d got %d" % (test['num_filtered'], stats['num_records_filtered'])
+    if 'exclude_index_size' in test:
+        assert stats['exclude_index_size'] == test['exclude_index_size'], "Wrong exclude index size! expected %d got %d" % (test['exclude_index_size'], stats['exclude_index_size'])
 
     os.unlink(exclude_list)
     os.unlink(stats_file)
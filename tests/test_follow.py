@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""Grow archives a chunk at a time, usually cutting a gzip member in half,
+index them with --follow-state after each chunk, and check that the result is
+the same as indexing the complete archive.
+"""
+
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+tests = [
+    {'file': 'test.warc.gz'},
+    {'file': 'test.warc.gz', 'output_compression': 'gzip'},
+    {'file': 'test.arc.gz'},
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    make_warc(os.path.join(tmp_dir, 'test.warc.gz'), 200, non_ascii_fraction=0.2, max_payload=4096)
+    make_arc(os.path.join(tmp_dir, 'test.arc.gz'), 200, non_ascii_fraction=0.2, latin1_fraction=0.2, max_payload=4096)
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test['file']
+        data     = open(os.path.join(tmp_dir, test['file']), 'rb').read()
+        archive  = os.path.join(tmp_dir, 'growing_' + test['file'])
+        expected = os.path.join(tmp_dir, 'expected.cdx')
+        output   = os.path.join(tmp_dir, 'output.cdx')
+        state    = os.path.join(tmp_dir, 'follow.json')
+        options  = {'all_records': True, 'output_compression': test.get('output_compression')}
+
+        rng = random.Random(test_num)
+        size = 0
+        num_included = 0
+        while size < len(data):
+            size = min(len(data), size + rng.randint(1, len(data) / 8))
+            f = open(archive, 'wb')
+            f.write(data[:size])
+            f.close()
+            stats = cdx_writer.CDX_Writer(archive, output, follow_state=state, **options).make_cdx()
+            num_included += stats['num_records_included']
+
+        expected_stats = cdx_writer.CDX_Writer(archive, expected, **options).make_cdx()
+        assert num_included == expected_stats['num_records_included'], "records were indexed more than once"
+
+        read = gzip.open if test.get('output_compression') else open
+        assert read(output, 'rb').read() == read(expected, 'rb').read(), "followed output differs"
+
+        for path in (archive, expected, output, state):
+            os.unlink(path)
+        test_num += 1
+
+    #followers of different inputs that share a state file, running at the
+    #same time, must not lose each other's offsets
+    print "processing #", test_num, "shared state file"
+    state = os.path.join(tmp_dir, 'shared.json')
+    archives = []
+    for i in range(4):
+        archive = os.path.join(tmp_dir, 'shared%d.warc.gz' % i)
+        make_warc(archive, 100, seed=i, max_payload=4096)
+        archives.append((archive, open(archive, 'rb').read()))
+    for step in range(1, 5):
+        followers = []
+        for archive, data in archives:
+            f = open(archive + '.open', 'wb')
+            f.write(data[:len(data) * step / 4])
+            f.close()
+            followers.append(subprocess.Popen([sys.executable, '../cdx_writer.py', '--all-records', '--follow-state=' + state,
+                                               archive + '.open', archive + '.cdx']))
+        for p in followers:
+            assert 0 == p.wait()
+    for archive, data in archives:
+        expected = os.path.join(tmp_dir, 'expected.cdx')
+        cdx_writer.CDX_Writer(archive + '.open', expected, all_records=True).make_cdx()
+        assert open(archive + '.cdx', 'rb').read() == open(expected, 'rb').read(), "followed output differs"
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""Run --resume, --follow-state and a spool-only --daemon in fresh processes,
+where nothing has imported the modules cdx_writer.py loads lazily, and check
+their output against runs in this process.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+class InterruptedWriter(cdx_writer.CDX_Writer):
+    """Raises KeyboardInterrupt when it gets to record number stop_at."""
+    stop_at = None
+
+    def get_massaged_url(self, record, use_precalculated_value=True):
+        if not use_precalculated_value and self.stats['num_records_processed'] == self.stop_at:
+            raise KeyboardInterrupt
+        return cdx_writer.CDX_Writer.get_massaged_url(self, record, use_precalculated_value)
+
+# run()
+#_______________________________________________________________________________
+def run(*args):
+    assert 0 == subprocess.call([sys.executable, '../cdx_writer.py'] + list(args))
+
+# wait_for()
+#_______________________________________________________________________________
+def wait_for(condition, seconds=60):
+    for i in range(seconds * 10):
+        if condition():
+            return
+        time.sleep(0.1)
+    assert False, "timed out"
+
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    warc     = os.path.join(tmp_dir, 'test.warc.gz')
+    arc      = os.path.join(tmp_dir, 'test.arc.gz')
+    expected = os.path.join(tmp_dir, 'expected.cdx')
+    output   = os.path.join(tmp_dir, 'output.cdx')
+    make_warc(warc, 200, non_ascii_fraction=0.2, max_payload=4096)
+    make_arc(arc, 200, non_ascii_fraction=0.2, latin1_fraction=0.2, max_payload=4096)
+
+    for archive in (warc, arc):
+        print "processing # 0 --resume", os.path.basename(archive)
+        cdx_writer.CDX_Writer(archive, expected, all_records=True).make_cdx()
+        writer = InterruptedWriter(archive, output, all_records=True, checkpoint_interval=20)
+        writer.stop_at = 110
+        try:
+            writer.make_cdx()
+            assert False, "run wasn't interrupted"
+        except KeyboardInterrupt:
+            pass
+        run('--resume', '--all-records', archive, output)
+        assert open(output, 'rb').read() == open(expected, 'rb').read(), "resumed output differs"
+        os.unlink(output)
+
+    print "processing # 1 --follow-state"
+    data    = open(warc, 'rb').read()
+    growing = os.path.join(tmp_dir, 'growing.warc.gz')
+    state   = os.path.join(tmp_dir, 'follow.json')
+    cdx_writer.CDX_Writer(warc, expected, all_records=True).make_cdx()
+    for size in (len(data) / 3, 2 * len(data) / 3, len(data)):
+        f = open(growing, 'wb')
+        f.write(data[:size])
+        f.close()
+        run('--follow-state=' + state, '--all-records', growing, output)
+    assert os.path.exists(state)
+    assert open(output, 'rb').read() == open(expected, 'rb').read().replace('test.warc.gz', 'growing.warc.gz'), "followed output differs"
+    os.unlink(output)
+
+    print "processing # 2 --daemon --spool-dir"
+    spool_dir = os.path.join(tmp_dir, 'spool')
+    os.mkdir(spool_dir)
+    f = open(os.path.join(spool_dir, 'test.job'), 'w')
+    json.dump({'input': warc, 'output': output, 'options': {'all_records': True}}, f)
+    f.close()
+    daemon = subprocess.Popen([sys.executable, '../cdx_writer.py', '--daemon', '--processes=1',
+                               '--spool-dir=' + spool_dir, '--poll-interval=0.1'])
+    try:
+        wait_for(lambda: os.listdir(spool_dir) != ['test.job'] and not os.path.exists(os.path.join(spool_dir, 'test.job.running')))
+    finally:
+        daemon.terminate()
+        assert 0 == daemon.wait()
+    assert ['test.job.done'] == os.listdir(spool_dir), os.listdir(spool_dir)
+    assert open(output, 'rb').read() == open(expected, 'rb').read(), "spooled output differs"
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+"""Merge sorted cdx files of synthetic WARCs into a block compressed index and
+check it against sorting all of their lines, block by block.
+"""
+
+import os
+import sys
+import gzip
+import zlib
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc
+
+
+tests = [
+    {'block_lines': 100},
+    {'block_lines': 7},
+    {'block_lines': 0},
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    inputs = []
+    for i in range(3):
+        archive = os.path.join(tmp_dir, 'test%d.warc.gz' % i)
+        make_warc(archive, 300, seed=i, max_payload=4096)
+        cdx_file = archive + '.cdx.gz' if i else archive + '.cdx'
+        cdx_writer.CDX_Writer(archive, cdx_file, sort=True, all_records=True,
+                              output_compression='gzip' if i else None).make_cdx()
+        inputs.append(cdx_file)
+
+    lines = []
+    for cdx_file in inputs:
+        lines += (gzip.open if cdx_file.endswith('.gz') else open)(cdx_file, 'rb').read().splitlines()[1:]
+    expected = [' CDX N b a m s k r M S V g'] + sorted(lines)
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test['block_lines']
+        output = os.path.join(tmp_dir, 'index.cdx.gz' if test['block_lines'] else 'index.cdx')
+        stats = cdx_writer.merge_cdx_files(inputs, output, block_lines=test['block_lines'])
+        assert stats['num_lines'] == len(lines)
+
+        if not test['block_lines']:
+            assert open(output, 'rb').read().splitlines() == expected
+            os.unlink(output)
+            test_num += 1
+            continue
+
+        assert gzip.open(output, 'rb').read().splitlines() == expected
+        data = open(output, 'rb').read()
+        summary = open(output + '.idx', 'rb').read().splitlines()
+        assert len(summary) == stats['num_blocks'] == (len(lines) + test['block_lines'] - 1) / test['block_lines']
+
+        merged = []
+        for line in summary:
+            key, name, offset, length, num = line.split('\t')
+            assert 'index.cdx.gz' == name
+            block = zlib.decompress(data[int(offset):int(offset)+int(length)], 16+zlib.MAX_WBITS).splitlines()
+            assert len(block) <= test['block_lines']
+            assert key == cdx_writer.get_block_key(block[0])
+            merged += block
+        assert merged == expected[1:]
+        assert summary == sorted(summary)
+
+        os.unlink(output)
+        os.unlink(output + '.idx')
+        test_num += 1
+
+    print "processing #", test_num, "--merge=-"
+    p = subprocess.Popen([sys.executable, '../cdx_writer.py', '--merge=-'] + inputs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    assert 0 == p.returncode, err
+    assert out.splitlines() == expected
+    p = subprocess.Popen([sys.executable, '../cdx_writer.py', '--merge=-', '--block-lines=100'] + inputs, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    assert 2 == p.returncode and 'Traceback' not in err, err
+    test_num += 1
+
+    print "processing #", test_num, "errors"
+    other_format = os.path.join(tmp_dir, 'other.cdx')
+    cdx_writer.CDX_Writer(os.path.join(tmp_dir, 'test0.warc.gz'), other_format, format='N b a', sort=True).make_cdx()
+    unsorted = os.path.join(tmp_dir, 'unsorted.cdx')
+    f = open(unsorted, 'wb')
+    f.write('\n'.join([expected[0]] + expected[:0:-1]) + '\n')
+    f.close()
+    for bad_input in (other_format, unsorted):
+        try:
+            cdx_writer.merge_cdx_files(inputs + [bad_input], os.path.join(tmp_dir, 'index.cdx.gz'))
+            assert False, "bad input wasn't detected"
+        except ValueError:
+            pass
+        assert not os.path.exists(os.path.join(tmp_dir, 'index.cdx.gz'))
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""Check that parse_meta_tags() only finds meta tags in the head: scanning
+stops at </head>, at <body>, and after meta_tag_budget bytes.
+"""
+
+import sys
+import subprocess
+from StringIO import StringIO
+
+sys.path.insert(0, '..')
+import cdx_writer
+
+
+class FakeRecord(object):
+    type = 'response'
+
+    def __init__(self, content):
+        self.content_length = len(content)
+
+
+robots  = '<meta name="robots" content="noindex">'
+archive = '<meta name="robots" content="noarchive">'
+padding = '<!--' + 'x' * 2000 + '-->'
+
+tests = [
+    #(html, meta_tag_budget, expected meta tags)
+    ('<html><head>%s</head><body>hello</body></html>' % robots,                    4096, {'robots': 'noindex'}),
+    ('<html><head>%s%s</head></html>' % (robots, archive),                        4096, {'robots': 'noindex,noarchive'}),
+    ('<html><head><noscript>%s</noscript></head></html>' % robots,                 4096, {'robots': 'noindex'}),
+    ('<html><head></head><body>%s</body></html>' % robots,                         4096, {}),
+    #no </head>, the body still ends the head
+    ('<html><head>%s<body>%s</body></html>' % (robots, archive),                   4096, {'robots': 'noindex'}),
+    ('<html><BODY class="x">%s</BODY></html>' % robots,                            4096, {}),
+    #<bodyx> isn't a body tag
+    ('<html><head><bodyx>%s</head></html>' % robots,                               4096, {'robots': 'noindex'}),
+    #tags past the budget are ignored, also when there is no </head> or <body>
+    ('<html><head>%s%s%s</head></html>' % (robots, padding, archive),              1024, {'robots': 'noindex'}),
+    ('<html><head>%s%s' % (padding, robots),                                       1024, {}),
+    ('<html><head>%s%s' % (padding, robots),                                       4096, {'robots': 'noindex'}),
+    #a tag that straddles the budget is cut off, so it doesn't match
+    ('<html><head>%s' % robots,                                  len('<html><head>') + 10, {}),
+    ('',                                                                           4096, {}),
+]
+
+test_num = 0
+for html, budget, expected in tests:
+    print "processing #", test_num, repr(html[:40])
+    writer = cdx_writer.CDX_Writer('unused.warc.gz', StringIO(), meta_tag_budget=budget)
+    writer.mime_type = 'text/html'
+    writer.content   = html
+    meta_tags = writer.parse_meta_tags(FakeRecord(html))
+    assert meta_tags == expected, (html, meta_tags, expected)
+    test_num += 1
+
+print "processing #", test_num, "negative options"
+for option in ('--meta-tag-budget=-1', '--block-lines=-1', '--processes=0'):
+    p = subprocess.Popen([sys.executable, '../cdx_writer.py', option, 'wget_ia.warc.gz'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    assert 2 == p.returncode and 'error: --' in err and 'Traceback' not in err, err
+
+print "exiting without errors!"
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""Index single records by offset, with and without a length, and check that
+each cdx line is the same as the line for that record in a full run.
+"""
+
+import os
+import re
+import sys
+import random
+import shutil
+import tempfile
+from StringIO import StringIO
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+tests = [
+    {'file': 'test.warc.gz'},
+    {'file': 'test.warc'},
+    {'file': 'test.arc.gz'},
+    #an uncompressed arc file has nothing that tells a record header from a
+    #line of content, so a bad offset can't be detected
+    {'file': 'test.arc', 'bad_offset': False},
+    #urls in legacy encodings must come out the same without the records
+    #before them
+    {'file': 'legacy.warc.gz', 'non_ascii': True},
+    {'file': 'legacy.arc.gz', 'non_ascii': True},
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    make_warc(os.path.join(tmp_dir, 'test.warc.gz'), 100, non_ascii_fraction=0.2, max_payload=4096)
+    make_warc(os.path.join(tmp_dir, 'test.warc'), 100, compress=False, max_payload=4096)
+    make_arc(os.path.join(tmp_dir, 'test.arc.gz'), 100, non_ascii_fraction=0.2, latin1_fraction=0.2, max_payload=4096)
+    make_arc(os.path.join(tmp_dir, 'test.arc'), 100, compress=False, max_payload=4096)
+    make_warc(os.path.join(tmp_dir, 'legacy.warc.gz'), 100, legacy_fraction=0.4, max_payload=4096)
+    make_arc(os.path.join(tmp_dir, 'legacy.arc.gz'), 100, legacy_fraction=0.4, max_payload=4096)
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test['file']
+        archive = os.path.join(tmp_dir, test['file'])
+
+        output = StringIO()
+        cdx_writer.CDX_Writer(archive, output, all_records=True).make_cdx()
+        lines = output.getvalue().splitlines()[1:]
+
+        rng = random.Random(test_num)
+        sample = rng.sample(lines, 20) + [lines[0], lines[-1]]
+        if test.get('non_ascii'):
+            sample = [line for line in lines if re.search(r'[\x80-\xff]', line.split(' ')[2])]
+            assert len(sample) > 20
+        for use_length in (True, False):
+            offsets = []
+            for line in sample:
+                fields = line.split(' ')
+                offsets.append((int(fields[-2]), int(fields[-3]) if use_length else None))
+
+            output = StringIO()
+            cdx_writer.CDX_Writer(archive, output, all_records=True, offsets=offsets).make_cdx()
+            assert output.getvalue().splitlines()[1:] == sample, "cdx lines differ from the full run"
+
+        if test.get('non_ascii'):
+            for line in sample:
+                fields = line.split(' ')
+                output = StringIO()
+                cdx_writer.CDX_Writer(archive, output, all_records=True, offsets=[(int(fields[-2]), None)]).make_cdx()
+                assert output.getvalue().splitlines()[1:] == [line], "cdx line differs from the full run"
+
+        if test.get('bad_offset', True):
+            try:
+                cdx_writer.CDX_Writer(archive, StringIO(), offsets=[(int(lines[1].split(' ')[-2]) + 1, None)]).make_cdx()
+                assert False, "bad offset wasn't detected"
+            except cdx_writer.ParseError:
+                pass
+        test_num += 1
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
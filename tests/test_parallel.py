@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""Index gzipped WARCs with --processes and check that the output is
+byte-identical to a serial run, for the test fixtures and for a synthetic
+WARC whose hosts mix urls in several legacy encodings.
+"""
+
+import os
+import sys
+import glob
+import shutil
+import tempfile
+from StringIO import StringIO
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc
+
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    synthetic = os.path.join(tmp_dir, 'legacy_urls.warc.gz')
+    make_warc(synthetic, 600, legacy_fraction=0.3, non_ascii_fraction=0.1, max_payload=4096)
+
+    tests = [(archive, True) for archive in sorted(glob.glob('*.warc.gz'))]
+    tests += [(synthetic, True), (synthetic, False)]
+
+    test_num = 0
+    for archive, all_records in tests:
+        print "processing #", test_num, os.path.basename(archive), 'all_records=%s' % all_records
+        serial = StringIO()
+        stats = cdx_writer.CDX_Writer(archive, serial, all_records=all_records).make_cdx()
+        for processes in (2, 5):
+            parallel = StringIO()
+            parallel_stats = cdx_writer.CDX_Writer(archive, parallel, all_records=all_records, processes=processes).make_cdx()
+            assert parallel.getvalue() == serial.getvalue(), "--processes=%d output differs" % processes
+            assert parallel_stats['num_records_included'] == stats['num_records_included']
+        test_num += 1
+
+    #the synthetic file must have urls that only chardet can decode, and
+    #urls decoded with the encoding of their host
+    assert stats['num_urls_decoded_chardet'] > 20, stats['num_urls_decoded_chardet']
+    assert stats['num_urls_decoded_by_host'] > 20, stats['num_urls_decoded_by_host']
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+"""Index synthetic archives with --profile and check the call counts: the
+stages whose value is calculated once per record, like surt canonicalization,
+must be counted once per record, not again when a cdx field reuses the value.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+from StringIO import StringIO
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+tests = [
+    {'file': 'test.warc.gz'},
+    {'file': 'test.warc.gz', 'exclude': 'http://archive.org/\n'},
+    {'file': 'test.arc.gz'},
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    make_warc(os.path.join(tmp_dir, 'test.warc.gz'), 200, max_payload=4096)
+    make_arc(os.path.join(tmp_dir, 'test.arc.gz'), 200, max_payload=4096)
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test['file'], repr(test.get('exclude'))
+        exclude_list = None
+        if 'exclude' in test:
+            exclude_list = os.path.join(tmp_dir, 'excludes.txt')
+            f = open(exclude_list, 'w')
+            f.write(test['exclude'])
+            f.close()
+
+        stats = cdx_writer.CDX_Writer(os.path.join(tmp_dir, test['file']), StringIO(), all_records=True,
+                                      exclude_list=exclude_list, profile=True).make_cdx()
+        profile = stats['profile']
+        num_surts = stats['num_records_included'] + stats['num_records_filtered']
+        assert profile['get_massaged_url']['calls'] == num_surts, (profile['get_massaged_url'], num_surts)
+        assert profile['should_exclude']['calls'] == num_surts
+        assert profile['get_mime_type']['calls'] == stats['num_records_included']
+        assert profile['get_new_style_checksum']['calls'] == stats['num_records_included']
+        if exclude_list:
+            assert stats['num_records_filtered'] > 0
+        test_num += 1
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
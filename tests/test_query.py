@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""Query sorted and block compressed cdx files of a synthetic WARC with
+cdx_query.py and check the results against filtering every line.
+"""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+from surt import surt
+
+sys.path.insert(0, '..')
+import cdx_writer
+import cdx_query
+from synthetic_warcs import make_warc
+
+
+# brute_force()
+#_______________________________________________________________________________
+def brute_force(lines, url, match_type, from_date, to_date):
+    key = surt(url)
+    results = []
+    for line in lines:
+        fields = line.split(' ')
+        if 'exact' == match_type and fields[0] != key:
+            continue
+        if 'prefix' == match_type and not fields[0].startswith(key):
+            continue
+        if 'host' == match_type and not fields[0].startswith(key[:key.index(')')+1]):
+            continue
+        if from_date and fields[1] < cdx_query.pad_date(from_date, '0'):
+            continue
+        if to_date and fields[1] > cdx_query.pad_date(to_date, '9'):
+            continue
+        results.append(line)
+    return results
+
+
+tests = [
+    {'file': 'sorted.cdx'},
+    {'file': 'index.cdx.gz', 'block_lines': 50},
+    {'file': 'index1.cdx.gz', 'block_lines': 1},
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    archive = os.path.join(tmp_dir, 'test.warc.gz')
+    make_warc(archive, 1000, repeat_url_fraction=0.5, max_payload=2048)
+    sorted_cdx = os.path.join(tmp_dir, 'sorted.cdx')
+    cdx_writer.CDX_Writer(archive, sorted_cdx, sort=True).make_cdx()
+    lines = open(sorted_cdx, 'rb').read().splitlines()[1:]
+
+    rng = random.Random(0)
+    urls = [line.split(' ')[2] for line in rng.sample(lines, 20)]
+    urls += ['http://example.jp/news/', 'https://archive.org/', 'http://www.example.com/', 'http://not-in-the-index.org/']
+    dates = [(None, None), ('2012', None), (None, '201201211703'), ('20120121170130', '201201211702')]
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test['file']
+        path = os.path.join(tmp_dir, test['file'])
+        if 'block_lines' in test:
+            cdx_writer.merge_cdx_files([sorted_cdx], path, block_lines=test['block_lines'])
+
+        cdx = cdx_query.SortedCDX(path)
+        for url in urls:
+            for match_type in cdx_query.match_types:
+                for from_date, to_date in dates:
+                    results = list(cdx.query(url, match_type, from_date, to_date))
+                    assert results == brute_force(lines, url, match_type, from_date, to_date), (url, match_type, from_date, to_date)
+        cdx.close()
+        test_num += 1
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
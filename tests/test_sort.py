@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""Index synthetic archives with --sort and a buffer small enough to spill
+many sorted runs, and check that the output, header included, is the same as
+piping the unsorted output through `LC_ALL=C sort`.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc, make_arc
+
+
+tests = [
+    {'file': 'test.warc.gz', 'buffer_size': 4096},
+    {'file': 'test.warc.gz', 'buffer_size': 4096, 'max_runs': 3}, #merges runs before the final merge
+    {'file': 'test.arc.gz',  'buffer_size': 1},                   #a run for every line
+    {'file': 'test.warc.gz', 'buffer_size': 100*1024*1024},       #no spills
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    #repeated urls captured in the same second give lines with equal keys
+    make_warc(os.path.join(tmp_dir, 'test.warc.gz'), 500, repeat_url_fraction=0.5, non_ascii_fraction=0.1, max_payload=2048)
+    make_arc(os.path.join(tmp_dir, 'test.arc.gz'), 200, repeat_url_fraction=0.5, max_payload=2048)
+
+    test_num = 0
+    for test in tests:
+        print "processing #", test_num, test['file'], test['buffer_size']
+        archive  = os.path.join(tmp_dir, test['file'])
+        unsorted = os.path.join(tmp_dir, 'unsorted.cdx')
+        expected = os.path.join(tmp_dir, 'expected.cdx')
+        output   = os.path.join(tmp_dir, 'output.cdx')
+
+        cdx_writer.CDX_Writer(archive, unsorted, all_records=True).make_cdx()
+        env = dict(os.environ, LC_ALL='C')
+        subprocess.check_call(['sort', '-o', expected, unsorted], env=env)
+
+        lines = open(unsorted, 'rb').read().splitlines()[1:]
+        keys = [' '.join(line.split(' ')[:2]) for line in lines]
+        assert len(set(keys)) < len(keys), "no duplicate keys"
+
+        spills = []
+        spill = cdx_writer.ExternalSort.spill
+        def counting_spill(self):
+            spills.append(len(self.lines))
+            spill(self)
+        cdx_writer.ExternalSort.spill = counting_spill
+        cdx_writer.ExternalSort.max_runs = test.get('max_runs', 64)
+        try:
+            cdx_writer.CDX_Writer(archive, output, all_records=True, sort=True, sort_buffer_size=test['buffer_size']).make_cdx()
+        finally:
+            cdx_writer.ExternalSort.spill = spill
+            cdx_writer.ExternalSort.max_runs = 64
+
+        if test['buffer_size'] < 1024*1024:
+            assert len(spills) > 3, "sort didn't spill"
+        else:
+            assert not spills
+        assert open(output, 'rb').read() == open(expected, 'rb').read(), "sorted output differs from sort(1)"
+
+        for path in (unsorted, expected, output):
+            os.unlink(path)
+        test_num += 1
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
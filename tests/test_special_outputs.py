@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+"""Write cdx output to paths that aren't regular files, a fifo and a symlink.
+They must be written in place, not replaced by a renamed temp file.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import subprocess
+
+
+archive = 'wget_ia.warc.gz'
+tmp_dir = tempfile.mkdtemp()
+try:
+    regular = os.path.join(tmp_dir, 'regular.cdx')
+    subprocess.check_call([sys.executable, '../cdx_writer.py', archive, regular])
+    expected = open(regular, 'rb').read()
+    assert expected.startswith(' CDX ')
+
+    print "processing # 0 fifo"
+    fifo = os.path.join(tmp_dir, 'fifo.cdx')
+    os.mkfifo(fifo)
+    received = []
+    reader = threading.Thread(target=lambda: received.append(open(fifo, 'rb').read()))
+    reader.daemon = True
+    reader.start()
+    subprocess.check_call([sys.executable, '../cdx_writer.py', archive, fifo])
+    reader.join(60)
+    assert received == [expected]
+    assert not [f for f in os.listdir(tmp_dir) if '.tmp.' in f]
+
+    print "processing # 1 symlink"
+    target = os.path.join(tmp_dir, 'target.cdx')
+    link   = os.path.join(tmp_dir, 'link.cdx')
+    open(target, 'wb').close()
+    os.symlink(target, link)
+    subprocess.check_call([sys.executable, '../cdx_writer.py', archive, link])
+    assert os.path.islink(link)
+    assert open(target, 'rb').read() == expected
+
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""Check the LRU cache around surt canonicalization: hits and misses,
+eviction of the least recently used url, separate entries for screenshot
+mode, and the counters in the stats. The output must be the same with the
+cache disabled.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+from StringIO import StringIO
+from surt import surt
+
+sys.path.insert(0, '..')
+import cdx_writer
+from synthetic_warcs import make_warc
+
+
+class FakeRecord(object):
+    type = 'response'
+
+    def __init__(self, url):
+        self.url = url
+
+
+a, b, c = 'http://example.com/a', 'http://example.com/b', 'http://archive.org/'
+
+tests = [
+    #(cache size, screenshot mode, urls looked up, expected hits, expected misses, expected cached urls)
+    (2, False, [a, b, a, c],       1, 3, [a, c]),    #b is evicted, a was used more recently
+    (2, False, [a, b, a, c, b, a], 1, 5, [b, a]),    #b evicts a before a comes back
+    (3, False, [a, a, a, b, b],    3, 2, [a, b]),
+    (0, False, [a, a, b, b],       0, 4, []),        #disabled
+    (2, True,  [a, a],             1, 1, [a]),
+]
+
+test_num = 0
+for size, screenshot_mode, urls, hits, misses, cached in tests:
+    print "processing #", test_num, size, screenshot_mode
+    writer = cdx_writer.CDX_Writer('unused.warc.gz', StringIO(), surt_cache_size=size, screenshot_mode=screenshot_mode)
+    for url in urls:
+        expected = surt('http://web.archive.org/screenshot/' + url if screenshot_mode else url)
+        assert writer.get_massaged_url(FakeRecord(url), use_precalculated_value=False) == expected
+    assert writer.stats['surt_cache_hits'] == hits, writer.stats['surt_cache_hits']
+    assert writer.stats['surt_cache_misses'] == misses, writer.stats['surt_cache_misses']
+    if screenshot_mode:
+        cached = ['http://web.archive.org/screenshot/' + url for url in cached]
+    assert list(writer.surt_cache.entries.keys()) == [(url, screenshot_mode) for url in cached]
+    test_num += 1
+
+print "processing #", test_num, "stats file"
+tmp_dir = tempfile.mkdtemp()
+try:
+    archive = os.path.join(tmp_dir, 'test.warc.gz')
+    make_warc(archive, 500, repeat_url_fraction=0.5, max_payload=2048)
+
+    cached_output = StringIO()
+    stats = cdx_writer.CDX_Writer(archive, cached_output, all_records=True).make_cdx()
+    num_lookups = stats['surt_cache_hits'] + stats['surt_cache_misses']
+    assert stats['surt_cache_hits'] > 100
+    assert stats['surt_cache_hit_rate'] == round(float(stats['surt_cache_hits']) / num_lookups, 4)
+
+    uncached_output = StringIO()
+    stats = cdx_writer.CDX_Writer(archive, uncached_output, all_records=True, surt_cache_size=0).make_cdx()
+    assert 0 == stats['surt_cache_hits']
+    assert uncached_output.getvalue() == cached_output.getvalue()
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"
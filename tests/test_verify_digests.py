@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+"""Index a WARC whose WARC-Payload-Digest headers are partly wrong with
+--verify-digests, and check that exactly the mismatched records are reported.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import subprocess
+
+sys.path.insert(0, '..')
+from synthetic_warcs import gzip_member, sha1_base32, warc_record
+
+
+date = time.gmtime(1327165200)
+body = '<html><head><title>digest test</title></head><body>hello</body></html>\n'
+http = 'HTTP/1.1 200 OK\r\nContent-Type: text/html\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+resource = 'plain resource block\n'
+
+# (description, warc type, block, payload digest, content type, is mismatched)
+records = [
+    ('base32 digest',        'response', http,     'sha1:' + sha1_base32(body),              'application/http; msgtype=response', False),
+    ('wrong base32 digest',  'response', http,     'sha1:' + sha1_base32(body + 'x'),        'application/http; msgtype=response', True),
+    ('hex digest',           'response', http,     'sha1:' + hashlib.sha1(body).hexdigest(), 'application/http; msgtype=response', False),
+    ('wrong hex digest',     'response', http,     'sha1:' + hashlib.sha1('x').hexdigest(),  'application/http; msgtype=response', True),
+    ('digest of the block',  'response', http,     'sha1:' + sha1_base32(http),              'application/http; msgtype=response', True),
+    ('resource block',       'resource', resource, 'sha1:' + sha1_base32(resource),          'text/plain', False),
+    ('wrong resource block', 'resource', resource, 'sha1:' + sha1_base32(body),              'text/plain', True),
+    ('revisit, not checked', 'revisit',  'HTTP/1.1 200 OK\r\n\r\n', 'sha1:' + sha1_base32('x'), 'application/http; msgtype=response', False),
+    ('md5, not checked',     'response', http,     'md5:' + hashlib.md5('x').hexdigest(),    'application/http; msgtype=response', False),
+]
+
+tmp_dir = tempfile.mkdtemp()
+try:
+    archive    = os.path.join(tmp_dir, 'digests.warc.gz')
+    stats_file = os.path.join(tmp_dir, 'stats.json')
+
+    f = open(archive, 'wb')
+    mismatch_offsets = []
+    for i, (description, warc_type, block, digest, content_type, mismatched) in enumerate(records):
+        if mismatched:
+            mismatch_offsets.append(f.tell())
+        f.write(gzip_member(warc_record(warc_type, date, block, 'http://example.com/%d' % i, content_type,
+                                        ['WARC-Payload-Digest: ' + digest])))
+    f.close()
+
+    print "processing # 0", os.path.basename(archive)
+    subprocess.check_call([sys.executable, '../cdx_writer.py', '--all-records', '--verify-digests',
+                           '--stats-file=' + stats_file, archive, os.path.join(tmp_dir, 'output.cdx')])
+    stats = json.load(open(stats_file))
+    assert stats['num_digests_verified'] == 7, stats['num_digests_verified']
+    assert stats['num_digest_mismatches'] == len(mismatch_offsets)
+    assert stats['digest_mismatch_offsets'] == mismatch_offsets, (stats['digest_mismatch_offsets'], mismatch_offsets)
+    assert stats['digest_bytes_hashed'] > 0
+
+    print "processing # 1 without --verify-digests"
+    os.unlink(stats_file)
+    subprocess.check_call([sys.executable, '../cdx_writer.py', '--all-records',
+                           '--stats-file=' + stats_file, archive, os.path.join(tmp_dir, 'output.cdx')])
+    stats = json.load(open(stats_file))
+    assert 0 == stats['num_digests_verified'] == stats['num_digest_mismatches']
+finally:
+    shutil.rmtree(tmp_dir)
+
+print "exiting without errors!"